@@ -1,52 +1,107 @@
 import asyncio
 import os
-from datetime import datetime
+import time
+from functools import lru_cache
+from typing import Final
 
-from aiohttp import web
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command
-from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.exceptions import TelegramNetworkError
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 from dotenv import load_dotenv
 
 import metrics_db
+import metrics_db_async
+from bot_session import make_session, start_health_server, warm_up
 
 
 load_dotenv()
 
 
-ADMIN_BOT_TOKEN = os.getenv("ADMIN_BOT_TOKEN", "")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+ADMIN_BOT_TOKEN: Final[str] = os.getenv("ADMIN_BOT_TOKEN", "")
+ADMIN_ID: Final[int] = int(os.getenv("ADMIN_ID", "0"))
+HEALTH_PORT: Final[int] = int(os.getenv("PORT", "10000"))
 
 
 router = Router()
 
 
+_ADMIN_START_TEXT = (
+    "Админка доступна.\n\n"
+    "Команды:\n"
+    "/stats\n"
+    "/users_today [курсор]\n"
+    "/videos_today [курсор]\n"
+    "/errors_today\n"
+    "/banned\n"
+    "/user <user_id>\n"
+    "/ban <user_id>\n"
+    "/unban <user_id>\n"
+)
+
+_STATS_TMPL = (
+    "Статистика за сегодня:\n\n"
+    "Пользователи всего: {total_users}\n"
+    "Новых сегодня: {new_users_today}\n"
+    "Активных сегодня: {active_users_today}\n\n"
+    "Видео: стартов {videos_started_today}\n"
+    "Видео: успех {videos_success_today}\n"
+    "Видео: ошибок {videos_error_today}\n"
+)
+
+
+@lru_cache(maxsize=4096)
 def _fmt_ts(ts: int) -> str:
-    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+    t = time.localtime(ts)
+    return f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}"
+
+
+def _fmt_dur(duration: float | None) -> str:
+    return f"{float(duration):.1f}s" if duration is not None else "-"
 
 
 def _is_admin(message: Message) -> bool:
     return bool(message.from_user and message.from_user.id == ADMIN_ID)
 
 
+async def _parse_uid(message: Message, command: CommandObject) -> int | None:
+    raw = (command.args or "").strip()
+    if not raw:
+        await message.answer(f"Использование: {command.prefix}{command.command} <user_id>")
+        return None
+
+    digits = raw[1:] if raw.startswith("-") else raw
+    if not digits.isdecimal():
+        await message.answer("user_id должен быть числом")
+        return None
+    return int(raw)
+
+
+_PAGE_SIZE = 50
+
+
+async def _parse_cursor(message: Message, command: CommandObject) -> tuple[int, int] | None | bool:
+    # Cursor "<ts>_<id>" is printed under a full page; returns False after reporting bad input.
+    raw = (command.args or "").strip()
+    if not raw:
+        return None
+    ts, _, row_id = raw.partition("_")
+    if not (ts.isdecimal() and row_id.isdecimal()):
+        await message.answer(f"Использование: {command.prefix}{command.command} [<ts>_<id>]")
+        return False
+    return int(ts), int(row_id)
+
+
+def _next_page_hint(command: CommandObject, rows: list, ts: int, row_id: int) -> str:
+    if len(rows) < _PAGE_SIZE:
+        return ""
+    return f"\n\nДальше: {command.prefix}{command.command} {ts}_{row_id}"
+
+
 @router.message(Command("start"))
 async def admin_start(message: Message):
     if not _is_admin(message):
         return
-    await message.answer(
-        "Админка доступна.\n\n"
-        "Команды:\n"
-        "/stats\n"
-        "/users_today\n"
-        "/videos_today\n"
-        "/errors_today\n"
-        "/banned\n"
-        "/user <user_id>\n"
-        "/ban <user_id>\n"
-        "/unban <user_id>\n"
-    )
+    await message.answer(_ADMIN_START_TEXT)
 
 
 @router.message(Command("errors_today"))
@@ -54,20 +109,18 @@ async def errors_today(message: Message):
     if not _is_admin(message):
         return
 
-    rows = [r for r in metrics_db.videos_today(limit=100) if r["event"] == "video_error"]
+    rows = [r for r in await metrics_db_async.videos_today(limit=100) if r.event == "video_error"]
     if not rows:
         await message.answer("Сегодня ошибок по видео нет.")
         return
 
-    lines: list[str] = ["Ошибки по видео за сегодня (последние 30):", ""]
-    for r in rows[:30]:
-        effect = r["effect"] or "-"
-        err = (r["error"] or "")
-        if err:
-            err = err[-400:]
-        lines.append(f"{_fmt_ts(int(r['ts']))} | uid={r['user_id']} | effect={effect} | {err}")
-
-    await message.answer("\n".join(lines))
+    body = "\n".join(
+        [
+            f"{_fmt_ts(r.ts)} | uid={r.user_id} | effect={r.effect or '-'} | {(r.error or '')[-400:]}"
+            for r in rows[:30]
+        ]
+    )
+    await message.answer("Ошибки по видео за сегодня (последние 30):\n\n" + body)
 
 
 @router.message(Command("banned"))
@@ -75,17 +128,19 @@ async def banned_list(message: Message):
     if not _is_admin(message):
         return
 
-    rows = metrics_db.banned_users(limit=50)
+    rows = await metrics_db_async.banned_users(limit=50)
 
     if not rows:
         await message.answer("Забаненных пользователей нет.")
         return
 
-    lines: list[str] = ["Забаненные пользователи (последние 50):", ""]
-    for r in rows:
-        name = r["username"] or r["full_name"] or "(no name)"
-        lines.append(f"{r['user_id']} | {name} | last: {_fmt_ts(int(r['last_seen_ts']))}")
-    await message.answer("\n".join(lines))
+    body = "\n".join(
+        [
+            f"{r.user_id} | {r.username or r.full_name or '(no name)'} | last: {_fmt_ts(r.last_seen_ts)}"
+            for r in rows
+        ]
+    )
+    await message.answer("Забаненные пользователи (последние 50):\n\n" + body)
 
 
 @router.message(Command("stats"))
@@ -93,77 +148,73 @@ async def stats(message: Message):
     if not _is_admin(message):
         return
 
-    s = metrics_db.stats_today()
-    await message.answer(
-        "Статистика за сегодня:\n\n"
-        f"Пользователи всего: {s['total_users']}\n"
-        f"Новых сегодня: {s['new_users_today']}\n"
-        f"Активных сегодня: {s['active_users_today']}\n\n"
-        f"Видео: стартов {s['videos_started_today']}\n"
-        f"Видео: успех {s['videos_success_today']}\n"
-        f"Видео: ошибок {s['videos_error_today']}\n"
-    )
+    await message.answer(_STATS_TMPL.format_map(await metrics_db_async.stats_today()))
 
 
 @router.message(Command("users_today"))
-async def users_today(message: Message):
+async def users_today(message: Message, command: CommandObject):
     if not _is_admin(message):
         return
 
-    rows = metrics_db.users_today(limit=50)
+    after = await _parse_cursor(message, command)
+    if after is False:
+        return
+    rows = await metrics_db_async.users_today(limit=_PAGE_SIZE, after=after)
     if not rows:
         await message.answer("Сегодня новых пользователей нет.")
         return
 
-    lines: list[str] = ["Новые пользователи за сегодня (последние 50):", ""]
-    for r in rows:
-        name = r["username"] or r["full_name"] or "(no name)"
-        lines.append(f"{r['user_id']} | {name} | first: {_fmt_ts(int(r['first_seen_ts']))}")
-
-    await message.answer("\n".join(lines))
+    body = "\n".join(
+        [
+            f"{r.user_id} | {r.username or r.full_name or '(no name)'} | first: {_fmt_ts(r.first_seen_ts)}"
+            for r in rows
+        ]
+    )
+    last = rows[-1]
+    await message.answer(
+        "Новые пользователи за сегодня (последние 50):\n\n"
+        + body
+        + _next_page_hint(command, rows, last.first_seen_ts, last.user_id)
+    )
 
 
 @router.message(Command("videos_today"))
-async def videos_today(message: Message):
+async def videos_today(message: Message, command: CommandObject):
     if not _is_admin(message):
         return
 
-    rows = metrics_db.videos_today(limit=50)
+    after = await _parse_cursor(message, command)
+    if after is False:
+        return
+    rows = await metrics_db_async.videos_today(limit=_PAGE_SIZE, after=after)
     if not rows:
         await message.answer("Сегодня событий по видео нет.")
         return
 
-    lines: list[str] = ["Видео за сегодня (последние 50 событий):", ""]
-    for r in rows:
-        effect = r["effect"] or "-"
-        dur = f"{float(r['video_duration']):.1f}s" if r["video_duration"] is not None else "-"
-        err = (r["error"] or "")
-        if err:
-            err = err[:120]
-        lines.append(
-            f"{_fmt_ts(int(r['ts']))} | {r['event']} | uid={r['user_id']} | effect={effect} | dur={dur} | {err}"
-        )
-
-    await message.answer("\n".join(lines))
+    body = "\n".join(
+        [
+            f"{_fmt_ts(r.ts)} | {r.event} | uid={r.user_id} | effect={r.effect or '-'} | "
+            f"dur={_fmt_dur(r.video_duration)} | "
+            f"{(r.error or '')[:120]}"
+            for r in rows
+        ]
+    )
+    last = rows[-1]
+    await message.answer(
+        "Видео за сегодня (последние 50 событий):\n\n" + body + _next_page_hint(command, rows, last.ts, last.id)
+    )
 
 
 @router.message(Command("user"))
-async def user_card(message: Message):
+async def user_card(message: Message, command: CommandObject):
     if not _is_admin(message):
         return
 
-    parts = (message.text or "").split(maxsplit=1)
-    if len(parts) < 2:
-        await message.answer("Использование: /user <user_id>")
+    uid = await _parse_uid(message, command)
+    if uid is None:
         return
 
-    try:
-        uid = int(parts[1].strip())
-    except ValueError:
-        await message.answer("user_id должен быть числом")
-        return
-
-    card = metrics_db.user_card(uid)
+    card = await metrics_db_async.user_card(uid)
     if card is None:
         await message.answer("Пользователь не найден в базе.")
         return
@@ -182,42 +233,28 @@ async def user_card(message: Message):
 
 
 @router.message(Command("ban"))
-async def ban_user(message: Message):
+async def ban_user(message: Message, command: CommandObject):
     if not _is_admin(message):
         return
 
-    parts = (message.text or "").split(maxsplit=1)
-    if len(parts) < 2:
-        await message.answer("Использование: /ban <user_id>")
-        return
-
-    try:
-        uid = int(parts[1].strip())
-    except ValueError:
-        await message.answer("user_id должен быть числом")
+    uid = await _parse_uid(message, command)
+    if uid is None:
         return
 
-    metrics_db.set_banned(uid, True)
+    await metrics_db_async.set_banned(uid, True)
     await message.answer(f"Пользователь {uid} забанен.")
 
 
 @router.message(Command("unban"))
-async def unban_user(message: Message):
+async def unban_user(message: Message, command: CommandObject):
     if not _is_admin(message):
         return
 
-    parts = (message.text or "").split(maxsplit=1)
-    if len(parts) < 2:
-        await message.answer("Использование: /unban <user_id>")
-        return
-
-    try:
-        uid = int(parts[1].strip())
-    except ValueError:
-        await message.answer("user_id должен быть числом")
+    uid = await _parse_uid(message, command)
+    if uid is None:
         return
 
-    metrics_db.set_banned(uid, False)
+    await metrics_db_async.set_banned(uid, False)
     await message.answer(f"Пользователь {uid} разбанен.")
 
 
@@ -228,52 +265,27 @@ async def ignore_non_commands(message: Message):
     await message.answer("Напиши /stats")
 
 
-async def _start_health_server() -> web.AppRunner:
-    async def health(_: web.Request) -> web.Response:
-        return web.Response(text="ok")
-
-    app = web.Application()
-    app.router.add_get("/health", health)
-
-    runner = web.AppRunner(app)
-    await runner.setup()
-
-    port = int(os.getenv("PORT", "10000"))
-    site = web.TCPSite(runner, host="0.0.0.0", port=port)
-    await site.start()
-    return runner
-
-
 async def main() -> None:
     if not ADMIN_BOT_TOKEN:
         raise RuntimeError("ADMIN_BOT_TOKEN is not set")
     if not ADMIN_ID:
         raise RuntimeError("ADMIN_ID is not set")
 
-    health_runner = await _start_health_server()
+    health_runner = await start_health_server(HEALTH_PORT)
     metrics_db.init_db()
 
-    session = AiohttpSession(timeout=60)
+    session = make_session()
     bot = Bot(token=ADMIN_BOT_TOKEN, session=session)
     dp = Dispatcher()
     dp.include_router(router)
 
     try:
-        # Warm up connection + retries for unstable networks on Windows (WinError 121)
-        last_exc: Exception | None = None
-        for attempt in range(1, 6):
-            try:
-                await bot.get_me()
-                last_exc = None
-                break
-            except TelegramNetworkError as e:
-                last_exc = e
-                await asyncio.sleep(2 * attempt)
-
-        if last_exc is not None:
-            raise last_exc
-
-        await dp.start_polling(bot)
+        await warm_up(bot)
+        # Only poll for update types the router actually handles.
+        await dp.start_polling(
+            bot,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
     finally:
         await health_runner.cleanup()
         await bot.session.close()
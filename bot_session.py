@@ -0,0 +1,59 @@
+import asyncio
+import random
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramNetworkError
+
+
+# First attempt is immediate; retries back off exponentially with a little jitter.
+_WARMUP_DELAYS = (0.0, 0.25, 0.5, 1.0, 2.0, 4.0)
+
+# aiohttp responses are single-use, so only the encoded body is shared between requests.
+_HEALTH_BODY = b"ok"
+
+
+def make_session() -> AiohttpSession:
+    session = AiohttpSession(timeout=60)
+    # AiohttpSession builds its TCPConnector lazily from these kwargs (it has no public
+    # connector argument). One session per process serves every API call and file
+    # download, so keep its connections and DNS answers alive between requests.
+    session._connector_init.update(
+        limit=100,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+    return session
+
+
+async def warm_up(bot: Bot) -> None:
+    # Warm up connection + retries for unstable networks on Windows (WinError 121)
+    last_exc: Exception | None = None
+    for delay in _WARMUP_DELAYS:
+        if delay:
+            await asyncio.sleep(delay + random.uniform(0, 0.1))
+        try:
+            await bot.get_me()
+            return
+        except TelegramNetworkError as e:
+            last_exc = e
+
+    raise last_exc
+
+
+async def _health(_: web.Request) -> web.Response:
+    return web.Response(body=_HEALTH_BODY, content_type="text/plain")
+
+
+async def start_health_server(port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/health", _health)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    site = web.TCPSite(runner, host="0.0.0.0", port=port)
+    await site.start()
+    return runner
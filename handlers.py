@@ -1,26 +1,43 @@
 import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 
 from aiogram import F, Router
 from aiogram.enums import ContentType
 from aiogram.types import KeyboardButton, Message, ReplyKeyboardMarkup
 
 import metrics_db
-from video_processing import convert_video_to_circle
+import metrics_db_async
+from video_processing import FFMPEG_SEM, convert_video_to_circle
 
 
 router = Router()
 
 
-_user_locks: dict[int, asyncio.Lock] = {}
-_media_group_first_message: dict[str, int] = {}
-_global_video_lock = asyncio.Lock()
-_user_effect: dict[int, str] = {}
+@dataclass
+class _UserCtx:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    effect: str = "normal"
+
+
+# Per-user state is kept in LRU order and capped so memory does not grow with every
+# user the bot has ever seen.
+_MAX_USER_CTX = 200_000
+
+_user_ctx: OrderedDict[int, _UserCtx] = OrderedDict()
+# media_group_id -> (first message_id, expiry on the monotonic clock).
+_MEDIA_GROUP_TTL = 300.0
+_MEDIA_GROUP_PRUNE_AT = 1024
+_media_group_first_message: dict[str, tuple[int, float]] = {}
+_MAX_VIDEO_BYTES = 8 * 1024 * 1024
 
 
 def _track_user(message: Message) -> int:
     user_id = message.from_user.id if message.from_user else 0
     if user_id and message.from_user:
-        metrics_db.upsert_user_seen(
+        # Only records the user; metrics_db's writer thread upserts in batches.
+        metrics_db.mark_user_seen(
             metrics_db.TgUserInfo(
                 user_id=user_id,
                 username=message.from_user.username,
@@ -30,6 +47,21 @@ def _track_user(message: Message) -> int:
     return user_id
 
 
+def _get_user_ctx(user_id: int) -> _UserCtx:
+    ctx = _user_ctx.get(user_id)
+    if ctx is None:
+        ctx = _user_ctx[user_id] = _UserCtx()
+        for _ in range(len(_user_ctx) - _MAX_USER_CTX):
+            oldest_id, oldest = next(iter(_user_ctx.items()))
+            if oldest.lock.locked():
+                # Never drop a lock that is guarding a running conversion.
+                _user_ctx.move_to_end(oldest_id)
+            else:
+                del _user_ctx[oldest_id]
+    _user_ctx.move_to_end(user_id)
+    return ctx
+
+
 BTN_NORMAL = "Обычный кружок"
 BTN_EFFECTS = "Эффекты"
 BTN_BACK = "Назад"
@@ -40,31 +72,53 @@ BTN_MEME = "Сюрпризный мем 🐸"
 BTN_ECHO = "Эхо голоса 👻"
 BTN_SHAKE = "Размытие/дрожь камеры 🎥"
 
-
-def _main_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=BTN_NORMAL), KeyboardButton(text=BTN_EFFECTS)]],
-        resize_keyboard=True,
-    )
-
-
-def _effects_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=BTN_SPEED_SLOW)],
-            [KeyboardButton(text=BTN_FLASH)],
-            [KeyboardButton(text=BTN_MEME)],
-            [KeyboardButton(text=BTN_ECHO)],
-            [KeyboardButton(text=BTN_SHAKE)],
-            [KeyboardButton(text=BTN_BACK)],
-        ],
-        resize_keyboard=True,
-    )
-
-
-async def _forget_media_group(media_group_id: str) -> None:
-    await asyncio.sleep(300)
-    _media_group_first_message.pop(media_group_id, None)
+_BTN_TO_EFFECT = {
+    BTN_NORMAL: "normal",
+    BTN_SPEED_SLOW: "speed_slow",
+    BTN_FLASH: "flash",
+    BTN_MEME: "meme",
+    BTN_ECHO: "echo",
+    BTN_SHAKE: "shake",
+}
+_EFFECT_BUTTONS = frozenset(_BTN_TO_EFFECT)
+
+
+_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=BTN_NORMAL), KeyboardButton(text=BTN_EFFECTS)]],
+    resize_keyboard=True,
+)
+
+_EFFECTS_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=BTN_SPEED_SLOW)],
+        [KeyboardButton(text=BTN_FLASH)],
+        [KeyboardButton(text=BTN_MEME)],
+        [KeyboardButton(text=BTN_ECHO)],
+        [KeyboardButton(text=BTN_SHAKE)],
+        [KeyboardButton(text=BTN_BACK)],
+    ],
+    resize_keyboard=True,
+)
+
+
+_MSG_TOO_BIG = "❌ Ошибка: видео должно быть меньше 8 МБ. Пришли другое видео."
+_MSG_TOO_LONG = "❌ Я не могу обработать видео больше одной минуты. Пришли другое видео."
+_MSG_MEME_TOO_LONG = "❌ С эффектом мема видео должно быть до 55 секунд. Пришли другое видео."
+_MSG_BUSY = "❌ Подождите, пока обработается предыдущее видео."
+_MSG_BANNED = "❌ Доступ ограничен."
+_MSG_ALBUM = (
+    "❌ Бот работает только с одним видео за сообщение. "
+    "Отправь видео по одному (не альбомом)."
+)
+_MSG_QUEUED = "⏳ Сейчас обрабатывается другое видео. Ты в очереди — подожди немного."
+
+
+def _prune_media_groups(now: float) -> None:
+    if len(_media_group_first_message) <= _MEDIA_GROUP_PRUNE_AT:
+        return
+    expired = [k for k, (_, expiry) in _media_group_first_message.items() if expiry < now]
+    for k in expired:
+        del _media_group_first_message[k]
 
 
 @router.message(F.text == "/start")
@@ -79,148 +133,99 @@ async def start_handler(message: Message):
         "3️⃣ Получи кружок со звуком 🎥🔊\n\n"
         "⚠️ Видео до 60 секунд.\n\n"
         "Жду видео 👇",
-        reply_markup=_main_kb(),
+        reply_markup=_MAIN_KB,
     )
 
 
 @router.message(F.text == "/effects")
 async def effects_handler(message: Message):
     _track_user(message)
-    await message.answer("Выбери эффект для следующего кружка:", reply_markup=_effects_kb())
+    await message.answer("Выбери эффект для следующего кружка:", reply_markup=_EFFECTS_KB)
 
 
 @router.message(F.text == BTN_EFFECTS)
 async def effects_button_handler(message: Message):
     _track_user(message)
-    await message.answer("Выбери эффект для следующего кружка:", reply_markup=_effects_kb())
+    await message.answer("Выбери эффект для следующего кружка:", reply_markup=_EFFECTS_KB)
 
 
 @router.message(F.text == BTN_BACK)
 async def back_button_handler(message: Message):
     user_id = _track_user(message)
-    await message.answer("Ок", reply_markup=_main_kb())
+    await message.answer("Ок", reply_markup=_MAIN_KB)
 
 
-@router.message(F.text == BTN_NORMAL)
-async def set_effect_normal(message: Message):
+@router.message(F.text.in_(_EFFECT_BUTTONS))
+async def set_effect(message: Message):
     user_id = _track_user(message)
-    _user_effect[user_id] = "normal"
-    await message.answer("Ок, сделаю обычный кружок.", reply_markup=_main_kb())
-
-
-@router.message(F.text == BTN_SPEED_SLOW)
-async def set_effect_speed_slow(message: Message):
-    user_id = _track_user(message)
-    _user_effect[user_id] = "speed_slow"
-    await message.answer("Ок, эффект выбран.", reply_markup=_effects_kb())
-
-
-@router.message(F.text == BTN_FLASH)
-async def set_effect_flash(message: Message):
-    user_id = _track_user(message)
-    _user_effect[user_id] = "flash"
-    await message.answer("Ок, эффект выбран.", reply_markup=_effects_kb())
-
-
-@router.message(F.text == BTN_MEME)
-async def set_effect_meme(message: Message):
-    user_id = _track_user(message)
-    _user_effect[user_id] = "meme"
-    await message.answer("Ок, эффект выбран.", reply_markup=_effects_kb())
-
-
-@router.message(F.text == BTN_ECHO)
-async def set_effect_echo(message: Message):
-    user_id = _track_user(message)
-    _user_effect[user_id] = "echo"
-    await message.answer("Ок, эффект выбран.", reply_markup=_effects_kb())
-
-
-@router.message(F.text == BTN_SHAKE)
-async def set_effect_shake(message: Message):
-    user_id = _track_user(message)
-    _user_effect[user_id] = "shake"
-    await message.answer("Ок, эффект выбран.", reply_markup=_effects_kb())
+    effect = _BTN_TO_EFFECT[message.text]
+    _get_user_ctx(user_id).effect = effect
+    if effect == "normal":
+        await message.answer("Ок, сделаю обычный кружок.", reply_markup=_MAIN_KB)
+    else:
+        await message.answer("Ок, эффект выбран.", reply_markup=_EFFECTS_KB)
 
 
 @router.message(F.content_type == ContentType.VIDEO)
 async def video_to_circle(message: Message, bot):
-    user_id = _track_user(message)
-
-    if user_id and metrics_db.is_banned(user_id):
-        metrics_db.log_event(user_id, "banned_block", message_id=message.message_id)
-        await message.answer("❌ Доступ ограничен.")
+    video = message.video
+    user_id = message.from_user.id if message.from_user else 0
+    evt_base = {
+        "message_id": message.message_id,
+        "video_duration": float(video.duration) if video.duration is not None else None,
+        "video_file_size": int(video.file_size) if video.file_size is not None else None,
+    }
+
+    # Cheap metadata checks first: rejected uploads never reach the user/ban bookkeeping.
+    if video.file_size is not None and video.file_size >= _MAX_VIDEO_BYTES:
+        if user_id:
+            await metrics_db_async.log_event(user_id, "video_rejected", **evt_base, error="file_size_limit")
+        await message.answer(_MSG_TOO_BIG)
         return
 
-    media_group_id = getattr(message, "media_group_id", None)
-    if media_group_id:
-        first_message_id = _media_group_first_message.get(media_group_id)
-        if first_message_id is None:
-            _media_group_first_message[media_group_id] = message.message_id
-            asyncio.create_task(_forget_media_group(media_group_id))
-        elif first_message_id != message.message_id:
-            await message.answer(
-                "❌ Бот работает только с одним видео за сообщение. "
-                "Отправь видео по одному (не альбомом)."
-            )
-            return
+    if video.duration is not None and video.duration > 60:
+        if user_id:
+            await metrics_db_async.log_event(user_id, "video_rejected", **evt_base, error="duration_limit")
+        await message.answer(_MSG_TOO_LONG)
+        return
 
-    lock = _user_locks.get(user_id)
-    if lock is None:
-        lock = asyncio.Lock()
-        _user_locks[user_id] = lock
+    _track_user(message)
 
-    if lock.locked():
-        await message.answer("❌ Подождите, пока обработается предыдущее видео.")
+    if user_id and await metrics_db_async.is_banned(user_id):
+        await metrics_db_async.log_event(user_id, "banned_block", message_id=message.message_id)
+        await message.answer(_MSG_BANNED)
         return
 
-    video = message.video
+    media_group_id = getattr(message, "media_group_id", None)
+    if media_group_id:
+        now = time.monotonic()
+        _prune_media_groups(now)
+        entry = _media_group_first_message.get(media_group_id)
+        if entry is None or entry[1] < now:
+            _media_group_first_message[media_group_id] = (message.message_id, now + _MEDIA_GROUP_TTL)
+        elif entry[0] != message.message_id:
+            await message.answer(_MSG_ALBUM)
+            return
 
-    if video.file_size is not None and video.file_size >= 8 * 1024 * 1024:
-        if user_id:
-            metrics_db.log_event(
-                user_id,
-                "video_rejected",
-                message_id=message.message_id,
-                video_duration=float(video.duration) if video.duration is not None else None,
-                video_file_size=int(video.file_size) if video.file_size is not None else None,
-                error="file_size_limit",
-            )
-        await message.answer("❌ Ошибка: видео должно быть меньше 8 МБ. Пришли другое видео.")
-        return
+    ctx = _get_user_ctx(user_id)
 
-    if video.duration is not None and video.duration > 60:
-        if user_id:
-            metrics_db.log_event(
-                user_id,
-                "video_rejected",
-                message_id=message.message_id,
-                video_duration=float(video.duration),
-                video_file_size=int(video.file_size) if video.file_size is not None else None,
-                error="duration_limit",
-            )
-        await message.answer("❌ Я не могу обработать видео больше одной минуты. Пришли другое видео.")
+    if ctx.lock.locked():
+        await message.answer(_MSG_BUSY)
         return
 
-    effect = _user_effect.get(user_id, "normal")
+    effect = ctx.effect
 
     if effect == "meme" and video.duration is not None and video.duration > 55:
         if user_id:
-            metrics_db.log_event(
-                user_id,
-                "video_rejected",
-                message_id=message.message_id,
-                effect=effect,
-                video_duration=float(video.duration),
-                video_file_size=int(video.file_size) if video.file_size is not None else None,
-                error="duration_limit_for_meme",
+            await metrics_db_async.log_event(
+                user_id, "video_rejected", **evt_base, effect=effect, error="duration_limit_for_meme"
             )
-        await message.answer("❌ С эффектом мема видео должно быть до 55 секунд. Пришли другое видео.")
+        await message.answer(_MSG_MEME_TOO_LONG)
         return
 
-    async with lock:
-        if _global_video_lock.locked():
-            await message.answer("⏳ Сейчас обрабатывается другое видео. Ты в очереди — подожди немного.")
+    async with ctx.lock:
+        # Encodes are bounded by FFMPEG_SEM inside convert_video_to_circle; downloads are not.
+        if FFMPEG_SEM.locked():
+            await message.answer(_MSG_QUEUED)
 
-        async with _global_video_lock:
-            await convert_video_to_circle(message, bot, effect)
+        await convert_video_to_circle(message, bot, effect)
@@ -1,43 +1,28 @@
 import asyncio
-import os
 
 from aiohttp import web
 from aiogram import Bot, Dispatcher
-from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.exceptions import TelegramNetworkError
 
-from config import BOT_TOKEN
+from bot_session import make_session, start_health_server, warm_up
+from config import BOT_TOKEN, PORT
 from handlers import router
 import metrics_db
+import video_processing
 
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
-session = AiohttpSession(timeout=60)
+session = make_session()
 bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
 dp.include_router(router)
 
 
 async def _start_health_server() -> web.AppRunner:
-    port_str = os.getenv("PORT")
-    if not port_str:
+    if not PORT:
         raise RuntimeError("Health server disabled: PORT is not set")
-
-    async def health(_: web.Request) -> web.Response:
-        return web.Response(text="ok")
-
-    app = web.Application()
-    app.router.add_get("/health", health)
-
-    runner = web.AppRunner(app)
-    await runner.setup()
-
-    port = int(port_str)
-    site = web.TCPSite(runner, host="0.0.0.0", port=port)
-    await site.start()
-    return runner
+    return await start_health_server(int(PORT))
 
 
 async def main():
@@ -47,23 +32,20 @@ async def main():
     except Exception:
         health_runner = None
     metrics_db.init_db()
-    # Warm up connection + retries for unstable networks on Windows (WinError 121)
-    last_exc: Exception | None = None
-    for attempt in range(1, 6):
-        try:
-            await bot.get_me()
-            last_exc = None
-            break
-        except TelegramNetworkError as e:
-            last_exc = e
-            await asyncio.sleep(2 * attempt)
-
-    if last_exc is not None:
-        raise last_exc
-
+    await asyncio.to_thread(video_processing.video_args)
+    clip_cache_task = asyncio.create_task(video_processing.warm_clip_cache())
     try:
-        await dp.start_polling(bot)
+        await warm_up(bot)
+        # Each update is handled in its own task, so a long conversion never holds up
+        # other users' commands; only poll for update types the routers actually handle.
+        await dp.start_polling(
+            bot,
+            handle_as_tasks=True,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
     finally:
+        clip_cache_task.cancel()
+        await asyncio.to_thread(metrics_db.flush)
         if health_runner is not None:
             await health_runner.cleanup()
         await bot.session.close()
@@ -1,16 +1,92 @@
+import atexit
+import csv
+import io
 import os
+import queue
 import sqlite3
 import threading
 import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Final, Iterator, NamedTuple
 
 import psycopg2
 import psycopg2.extras
-
-
-_DB_LOCK = threading.Lock()
+import psycopg2.pool
+
+
+# Only writers serialize. Readers use their own per-thread SQLite connection (WAL lets
+# them run alongside the writer) or a pooled Postgres connection.
+_WRITE_LOCK = threading.Lock()
+_sqlite_conns: dict[str, sqlite3.Connection] = {}
+_sqlite_read_local = threading.local()
+_PG_POOL_LOCK = threading.Lock()
+_pg_pool: psycopg2.pool.ThreadedConnectionPool | None = None
+# ThreadedConnectionPool raises instead of waiting when it is exhausted, so callers queue here.
+_PG_POOL_MAX = 10
+_PG_POOL_SLOTS = threading.BoundedSemaphore(_PG_POOL_MAX)
+
+# WAL lets readers run alongside the writer, and synchronous=NORMAL drops the fsync on
+# every commit (WAL stays consistent; only the last commits can be lost on power loss).
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+)
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Ban status changes only via /ban and /unban, so is_banned() answers from this cache.
+# The admin bot runs in its own process; the TTL bounds how long the main bot can
+# keep serving a stale answer after a ban there. Entries are kept in LRU order and
+# capped so the cache does not grow with every user ever seen.
+_BAN_CACHE_TTL = 30.0
+_BAN_CACHE_MAX = 100_000
+_BAN_CACHE_LOCK = threading.Lock()
+_ban_cache: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+
+# log_event() only enqueues; a single writer thread inserts events in batches of up to
+# _EVENT_BATCH_MAX rows, waiting at most _EVENT_FLUSH_INTERVAL seconds to fill one.
+_EVENT_BATCH_MAX = 500
+_EVENT_FLUSH_INTERVAL = 0.1
+_EVENT_Q: queue.Queue[tuple[str, tuple]] = queue.Queue()
+_EVENT_WRITER_LOCK = threading.Lock()
+_event_writer: threading.Thread | None = None
+
+# active_users only needs one user_seen event per user per local day; users already
+# logged today by this process are skipped. Guarded by _WRITE_LOCK.
+_seen_today_start = 0
+_seen_today: set[int] = set()
+
+# mark_user_seen() only records the newest snapshot per user; the events writer thread
+# upserts everything pending at most every _USER_SEEN_FLUSH_INTERVAL seconds.
+_USER_SEEN_FLUSH_INTERVAL = 0.2
+_PENDING_LOCK = threading.Lock()
+_pending_users: dict[str, dict[int, "TgUserInfo"]] = {}
+
+# Above this many rows a Postgres batch goes through COPY instead of a multi-row INSERT.
+# An explicit NULL marker keeps empty strings distinct from NULL in the CSV stream.
+_EVENT_COPY_MIN_ROWS = 50
+_COPY_NULL = r"\N"
+
+
+# Events are filtered by a small-int id instead of their text name; the `event` text
+# column is still written so older rows and ad-hoc queries stay readable. The ids
+# are mirrored in the event_types table and hard-coded in the SQL below.
+_EVENT_ID = {
+    "user_seen": 1,
+    "video_start": 2,
+    "video_success": 3,
+    "video_error": 4,
+    "video_rejected": 5,
+    "banned_block": 6,
+}
 
 
 @dataclass(frozen=True)
@@ -20,6 +96,34 @@ class TgUserInfo:
     full_name: str | None
 
 
+# Row types returned by the admin listings; field order matches the SELECT column order.
+class UserRow(NamedTuple):
+    user_id: int
+    username: str | None
+    full_name: str | None
+    first_seen_ts: int
+    last_seen_ts: int
+
+
+class VideoRow(NamedTuple):
+    ts: int
+    user_id: int
+    event: str
+    effect: str | None
+    video_duration: float | None
+    video_file_size: int | None
+    error: str | None
+    message_id: int | None
+    id: int
+
+
+class BannedRow(NamedTuple):
+    user_id: int
+    username: str | None
+    full_name: str | None
+    last_seen_ts: int
+
+
 def _default_db_path() -> str:
     return str(Path(__file__).resolve().parent / "metrics.sqlite3")
 
@@ -34,32 +138,213 @@ def _is_postgres() -> bool:
 
 
 def _connect(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # Autocommit mode: writers open their own BEGIN IMMEDIATE in _sqlite_write().
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
+    for pragma in _SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _get_sqlite_conn(db_path: str) -> sqlite3.Connection:
+    # One connection per database file for the whole process: pragmas and sqlite3's
+    # statement cache survive between calls. Callers hold _WRITE_LOCK while using it.
+    conn = _sqlite_conns.get(db_path)
+    if conn is None:
+        conn = _sqlite_conns[db_path] = _connect(db_path)
+    return conn
+
+
+@contextmanager
+def _sqlite_write(db_path: str) -> Iterator[sqlite3.Connection]:
+    # Take the write lock up front instead of upgrading a read transaction mid-way,
+    # which under WAL can fail with SQLITE_BUSY regardless of busy_timeout.
+    conn = _get_sqlite_conn(db_path)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+
+def _get_sqlite_read_conn(db_path: str) -> sqlite3.Connection:
+    conns = getattr(_sqlite_read_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_read_local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = conns[db_path] = _connect(db_path)
     return conn
 
 
 def _pg_connect():
-    dsn = _pg_dsn()
-    if dsn is None:
-        raise RuntimeError("DATABASE_URL is not set")
-    return psycopg2.connect(dsn)
+    # The pool is created lazily: admin_bot loads .env only after importing this module.
+    global _pg_pool
+    if _pg_pool is None:
+        with _PG_POOL_LOCK:
+            if _pg_pool is None:
+                dsn = _pg_dsn()
+                if dsn is None:
+                    raise RuntimeError("DATABASE_URL is not set")
+                _pg_pool = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=_PG_POOL_MAX, dsn=dsn)
+                atexit.register(_pg_pool.closeall)
+    _PG_POOL_SLOTS.acquire()
+    try:
+        return _pg_pool.getconn()
+    except BaseException:
+        _PG_POOL_SLOTS.release()
+        raise
 
 
-def _row_to_dict(row) -> dict:
-    if row is None:
-        return {}
-    if isinstance(row, dict):
-        return row
+# Hot Postgres statements are parsed and planned once per pooled connection.
+_PG_PREPARE = (
+    "PREPARE p_is_banned(bigint) AS SELECT is_banned FROM users WHERE user_id = $1",
+)
+_pg_prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _pg_prepare(conn) -> None:
+    # Called after init_db() has created the tables; prepared statements survive the
+    # rollback putconn() does, so this runs once per connection.
+    if conn in _pg_prepared:
+        return
+    cur = conn.cursor()
+    for stmt in _PG_PREPARE:
+        cur.execute(stmt)
+    _pg_prepared[conn] = True
+
+
+def _pg_return(conn) -> None:
+    # putconn() rolls back whatever transaction the caller left open.
     try:
-        return dict(row)
-    except Exception:
-        return {k: row[k] for k in row.keys()}
+        _pg_pool.putconn(conn)
+    finally:
+        _PG_POOL_SLOTS.release()
+
+
+# Hot-path SQL is built once at import, so every call hands the driver the same string
+# object (sqlite3's statement cache is keyed by the SQL text).
+_EVENT_INSERT_COLS: Final[str] = "ts, user_id, event, event_id, message_id, effect, video_duration, video_file_size, error"
+_SQL_INSERT_EVENTS_PG: Final[str] = f"INSERT INTO events({_EVENT_INSERT_COLS}) VALUES %s"
+_SQL_COPY_EVENTS_PG: Final[str] = (
+    f"COPY events({_EVENT_INSERT_COLS}) FROM STDIN WITH (FORMAT CSV, NULL '{_COPY_NULL}')"
+)
+_SQL_INSERT_EVENTS_SQLITE: Final[str] = f"INSERT INTO events({_EVENT_INSERT_COLS}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_SQL_UPSERT_USERS_PG: Final[str] = """
+    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
+    VALUES %s
+    ON CONFLICT (user_id) DO UPDATE
+    SET username = EXCLUDED.username,
+        full_name = EXCLUDED.full_name,
+        last_seen_ts = EXCLUDED.last_seen_ts
+    RETURNING user_id, is_banned
+    """
+_SQL_USER_SEEN_EVENT_PG: Final[str] = "INSERT INTO events(ts, user_id, event, event_id) VALUES(%s, %s, 'user_seen', 1)"
+_SQL_UPSERT_USER_SQLITE: Final[str] = """
+    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
+    VALUES(?, ?, ?, ?, ?, 0)
+    ON CONFLICT(user_id) DO UPDATE
+    SET username = excluded.username,
+        full_name = excluded.full_name,
+        last_seen_ts = excluded.last_seen_ts
+    """
+_SQL_UPSERT_USER_RETURNING_SQLITE: Final[str] = _SQL_UPSERT_USER_SQLITE + "RETURNING user_id, is_banned"
+_SQL_USER_SEEN_EVENT_SQLITE: Final[str] = "INSERT INTO events(ts, user_id, event, event_id) VALUES(?, ?, 'user_seen', 1)"
+_SQL_IS_BANNED_SQLITE: Final[str] = "SELECT is_banned FROM users WHERE user_id = ?"
+_SQL_SET_BANNED_PG: Final[str] = """
+    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
+    VALUES(%s, NULL, NULL, %s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET is_banned = EXCLUDED.is_banned,
+        last_seen_ts = GREATEST(users.last_seen_ts, EXCLUDED.last_seen_ts)
+    """
+_SQL_SET_BANNED_SQLITE: Final[str] = """
+    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
+    VALUES(?, NULL, NULL, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE
+    SET is_banned = excluded.is_banned,
+        last_seen_ts = MAX(users.last_seen_ts, excluded.last_seen_ts)
+    """
+_SQL_STATS_TODAY_PG: Final[str] = """
+    SELECT
+        (SELECT COUNT(*) FROM users) AS total_users,
+        (SELECT COUNT(*) FROM users WHERE first_seen_ts BETWEEN %s AND %s) AS new_users,
+        COUNT(DISTINCT user_id) FILTER (WHERE event_id = 1) AS active_users,
+        COUNT(*) FILTER (WHERE event_id = 2) AS videos_started,
+        COUNT(*) FILTER (WHERE event_id = 3) AS videos_success,
+        COUNT(*) FILTER (WHERE event_id = 4) AS videos_error
+    FROM events
+    WHERE event_id IN (1, 2, 3, 4)  -- user_seen, video_start, video_success, video_error
+      AND ts BETWEEN %s AND %s
+    """
+_SQL_STATS_TODAY_SQLITE: Final[str] = """
+    SELECT
+        (SELECT COUNT(*) FROM users) AS total_users,
+        (SELECT COUNT(*) FROM users WHERE first_seen_ts BETWEEN ? AND ?) AS new_users,
+        COUNT(DISTINCT CASE WHEN event_id = 1 THEN user_id END) AS active_users,
+        SUM(CASE WHEN event_id = 2 THEN 1 ELSE 0 END) AS videos_started,
+        SUM(CASE WHEN event_id = 3 THEN 1 ELSE 0 END) AS videos_success,
+        SUM(CASE WHEN event_id = 4 THEN 1 ELSE 0 END) AS videos_error
+    FROM events
+    WHERE event_id IN (1, 2, 3, 4)  -- user_seen, video_start, video_success, video_error
+      AND ts BETWEEN ? AND ?
+    """
+# Listings page on (ts, unique id) so rows sharing a whole-second timestamp are never skipped.
+# The *_AFTER variants back the `after` cursor of users_today/videos_today: the (ts, id) of
+# the previous page's last row, i.e. (first_seen_ts, user_id) or (ts, events.id).
+_SQL_USERS_TODAY: Final[str] = """
+    SELECT user_id, username, full_name, first_seen_ts, last_seen_ts
+    FROM users
+    WHERE first_seen_ts BETWEEN {p} AND {p}{after}
+    ORDER BY first_seen_ts DESC, user_id DESC
+    LIMIT {p}
+    """
+_USERS_AFTER: Final[str] = "\n      AND (first_seen_ts, user_id) < ({p}, {p})"
+_SQL_USERS_TODAY_PG: Final[str] = _SQL_USERS_TODAY.format(p="%s", after="")
+_SQL_USERS_TODAY_SQLITE: Final[str] = _SQL_USERS_TODAY.format(p="?", after="")
+_SQL_USERS_TODAY_AFTER_PG: Final[str] = _SQL_USERS_TODAY.format(p="%s", after=_USERS_AFTER.format(p="%s"))
+_SQL_USERS_TODAY_AFTER_SQLITE: Final[str] = _SQL_USERS_TODAY.format(p="?", after=_USERS_AFTER.format(p="?"))
+_SQL_VIDEOS_TODAY: Final[str] = """
+    SELECT ts, user_id, event, effect, video_duration, video_file_size, error, message_id, id
+    FROM events
+    WHERE event_id IN (2, 3, 4)  -- video_start, video_success, video_error
+      AND ts BETWEEN {p} AND {p}{after}
+    ORDER BY ts DESC, id DESC
+    LIMIT {p}
+    """
+_VIDEOS_AFTER: Final[str] = "\n      AND (ts, id) < ({p}, {p})"
+_SQL_VIDEOS_TODAY_PG: Final[str] = _SQL_VIDEOS_TODAY.format(p="%s", after="")
+_SQL_VIDEOS_TODAY_SQLITE: Final[str] = _SQL_VIDEOS_TODAY.format(p="?", after="")
+_SQL_VIDEOS_TODAY_AFTER_PG: Final[str] = _SQL_VIDEOS_TODAY.format(p="%s", after=_VIDEOS_AFTER.format(p="%s"))
+_SQL_VIDEOS_TODAY_AFTER_SQLITE: Final[str] = _SQL_VIDEOS_TODAY.format(p="?", after=_VIDEOS_AFTER.format(p="?"))
+_SQL_BANNED_USERS_PG: Final[str] = """
+    SELECT user_id, username, full_name, last_seen_ts
+    FROM users
+    WHERE is_banned = TRUE
+    ORDER BY last_seen_ts DESC
+    LIMIT %s
+    """
+_SQL_BANNED_USERS_SQLITE: Final[str] = """
+    SELECT user_id, username, full_name, last_seen_ts
+    FROM users
+    WHERE is_banned = 1
+    ORDER BY last_seen_ts DESC
+    LIMIT ?
+    """
+_SQL_USER_CARD: Final[str] = """
+    SELECT u.user_id, u.username, u.full_name, u.first_seen_ts, u.last_seen_ts, u.is_banned,
+           COALESCE(SUM(CASE WHEN e.event_id = 3 THEN 1 ELSE 0 END), 0),
+           COALESCE(SUM(CASE WHEN e.event_id = 4 THEN 1 ELSE 0 END), 0)
+    FROM users u
+    LEFT JOIN events e
+        ON e.user_id = u.user_id AND e.event_id IN (3, 4)  -- video_success, video_error
+    WHERE u.user_id = {}
+    GROUP BY u.user_id
+    """
+_SQL_USER_CARD_PG: Final[str] = _SQL_USER_CARD.format("%s")
+_SQL_USER_CARD_SQLITE: Final[str] = _SQL_USER_CARD.format("?")
 
 
 def init_db(db_path: str | None = None) -> None:
     db = db_path or _default_db_path()
-    with _DB_LOCK:
+    with _WRITE_LOCK:
         if _is_postgres():
             conn = _pg_connect()
             try:
@@ -83,6 +368,7 @@ def init_db(db_path: str | None = None) -> None:
                         ts BIGINT NOT NULL,
                         user_id BIGINT NOT NULL,
                         event TEXT NOT NULL,
+                        event_id SMALLINT,
                         message_id BIGINT,
                         effect TEXT,
                         video_duration DOUBLE PRECISION,
@@ -91,14 +377,39 @@ def init_db(db_path: str | None = None) -> None:
                     )
                     """
                 )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS event_types (
+                        id SMALLINT PRIMARY KEY,
+                        name TEXT NOT NULL UNIQUE
+                    )
+                    """
+                )
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO event_types(id, name) VALUES %s ON CONFLICT (id) DO NOTHING",
+                    [(i, name) for name, i in _EVENT_ID.items()],
+                )
+                cur.execute(
+                    """
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'events' AND column_name = 'event_id'
+                    """
+                )
+                if cur.fetchone() is None:
+                    cur.execute("ALTER TABLE events ADD COLUMN event_id SMALLINT")
+                    cur.execute(
+                        "UPDATE events SET event_id = t.id FROM event_types t WHERE t.name = events.event"
+                    )
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts)")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events(user_id, ts)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_events_eid_ts ON events(event_id, ts)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_events_user_eid ON events(user_id, event_id)")
                 conn.commit()
             finally:
-                conn.close()
+                _pg_return(conn)
         else:
-            conn = _connect(db)
-            try:
+            with _sqlite_write(db) as conn:
                 conn.execute(
                     """
                     CREATE TABLE IF NOT EXISTS users (
@@ -118,6 +429,7 @@ def init_db(db_path: str | None = None) -> None:
                         ts INTEGER NOT NULL,
                         user_id INTEGER NOT NULL,
                         event TEXT NOT NULL,
+                        event_id INTEGER,
                         message_id INTEGER,
                         effect TEXT,
                         video_duration REAL,
@@ -126,71 +438,196 @@ def init_db(db_path: str | None = None) -> None:
                     )
                     """
                 )
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS event_types (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL UNIQUE
+                    )
+                    """
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO event_types(id, name) VALUES(?, ?)",
+                    [(i, name) for name, i in _EVENT_ID.items()],
+                )
+                cols = {r[1] for r in conn.execute("PRAGMA table_info(events)")}
+                if "event_id" not in cols:
+                    conn.execute("ALTER TABLE events ADD COLUMN event_id INTEGER")
+                    conn.execute(
+                        "UPDATE events SET event_id = (SELECT id FROM event_types WHERE name = events.event)"
+                    )
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts)")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events(user_id, ts)")
-                conn.commit()
-            finally:
-                conn.close()
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_events_eid_ts ON events(event_id, ts)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user_eid ON events(user_id, event_id)")
+
+
+def upsert_user_seen(user: TgUserInfo, ts: int | None = None, db_path: str | None = None) -> bool:
+    return upsert_users_seen_bulk([user], ts=ts, db_path=db_path)[user.user_id]
 
 
-def upsert_user_seen(user: TgUserInfo, ts: int | None = None, db_path: str | None = None) -> None:
+def upsert_users_seen_bulk(
+    users: list[TgUserInfo], ts: int | None = None, db_path: str | None = None
+) -> dict[int, bool]:
     db = db_path or _default_db_path()
     now_ts = int(ts or time.time())
 
-    with _DB_LOCK:
+    # Keep only the latest snapshot per user: one row write per user per batch.
+    latest = {u.user_id: u for u in users}
+    if not latest:
+        return {}
+
+    global _seen_today_start
+    day_start = _day_start_ts_local(now_ts)
+
+    with _WRITE_LOCK:
+        if day_start != _seen_today_start:
+            _seen_today_start = day_start
+            _seen_today.clear()
+        first_today = [uid for uid in latest if uid not in _seen_today]
+
         if _is_postgres():
             conn = _pg_connect()
             try:
                 cur = conn.cursor()
-                cur.execute(
-                    """
-                    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
-                    VALUES(%s, %s, %s, %s, %s, FALSE)
-                    ON CONFLICT (user_id) DO UPDATE
-                    SET username = EXCLUDED.username,
-                        full_name = EXCLUDED.full_name,
-                        last_seen_ts = EXCLUDED.last_seen_ts
-                    """,
-                    (user.user_id, user.username, user.full_name, now_ts, now_ts),
-                )
-                cur.execute(
-                    "INSERT INTO events(ts, user_id, event) VALUES(%s, %s, 'user_seen')",
-                    (now_ts, user.user_id),
+                banned = dict(
+                    psycopg2.extras.execute_values(
+                        cur,
+                        _SQL_UPSERT_USERS_PG,
+                        [(u.user_id, u.username, u.full_name, now_ts, now_ts) for u in latest.values()],
+                        template="(%s, %s, %s, %s, %s, FALSE)",
+                        fetch=True,
+                    )
                 )
+                cur.executemany(_SQL_USER_SEEN_EVENT_PG, [(now_ts, uid) for uid in first_today])
                 conn.commit()
             finally:
-                conn.close()
+                _pg_return(conn)
         else:
-            conn = _connect(db)
+            with _sqlite_write(db) as conn:
+                params = [(u.user_id, u.username, u.full_name, now_ts, now_ts) for u in latest.values()]
+                banned = {}
+                if _SQLITE_HAS_RETURNING:
+                    # executemany() cannot return rows; one cached statement per user instead.
+                    for p in params:
+                        uid, flag = conn.execute(_SQL_UPSERT_USER_RETURNING_SQLITE, p).fetchone()
+                        banned[uid] = bool(flag)
+                else:
+                    conn.executemany(_SQL_UPSERT_USER_SQLITE, params)
+                conn.executemany(_SQL_USER_SEEN_EVENT_SQLITE, [(now_ts, uid) for uid in first_today])
+        _seen_today.update(first_today)
+
+    # The upsert already read each user's ban flag, so the is_banned() check that
+    # follows a user's message is answered from the cache.
+    for uid, flag in banned.items():
+        _ban_cache_put(uid, flag)
+    for uid in latest.keys() - banned.keys():
+        banned[uid] = is_banned(uid, db_path)
+    return banned
+
+
+def _insert_events(db: str, rows: list[tuple]) -> None:
+    with _WRITE_LOCK:
+        if _is_postgres():
+            conn = _pg_connect()
             try:
-                row = conn.execute("SELECT user_id FROM users WHERE user_id = ?", (user.user_id,)).fetchone()
-                if row is None:
-                    conn.execute(
-                        """
-                        INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
-                        VALUES(?, ?, ?, ?, ?, 0)
-                        """,
-                        (user.user_id, user.username, user.full_name, now_ts, now_ts),
+                cur = conn.cursor()
+                if len(rows) > _EVENT_COPY_MIN_ROWS:
+                    buf = io.StringIO()
+                    csv.writer(buf).writerows(
+                        [_COPY_NULL if v is None else v for v in row] for row in rows
                     )
+                    buf.seek(0)
+                    cur.copy_expert(_SQL_COPY_EVENTS_PG, buf)
                 else:
-                    conn.execute(
-                        """
-                        UPDATE users
-                        SET username = ?, full_name = ?, last_seen_ts = ?
-                        WHERE user_id = ?
-                        """,
-                        (user.username, user.full_name, now_ts, user.user_id),
+                    psycopg2.extras.execute_values(
+                        cur,
+                        _SQL_INSERT_EVENTS_PG,
+                        rows,
+                        page_size=_EVENT_BATCH_MAX,
                     )
-                conn.execute(
-                    """
-                    INSERT INTO events(ts, user_id, event)
-                    VALUES(?, ?, 'user_seen')
-                    """,
-                    (now_ts, user.user_id),
-                )
                 conn.commit()
             finally:
-                conn.close()
+                _pg_return(conn)
+        else:
+            with _sqlite_write(db) as conn:
+                conn.executemany(_SQL_INSERT_EVENTS_SQLITE, rows)
+
+
+def _write_event_batch(batch: list[tuple[str, tuple]]) -> None:
+    by_db: dict[str, list[tuple]] = {}
+    for db, row in batch:
+        by_db.setdefault(db, []).append(row)
+    for db, rows in by_db.items():
+        try:
+            _insert_events(db, rows)
+        except Exception as e:
+            print("events flush failed:", e)
+
+
+def _flush_pending_users() -> None:
+    with _PENDING_LOCK:
+        if not _pending_users:
+            return
+        pending = dict(_pending_users)
+        _pending_users.clear()
+    for db, users in pending.items():
+        try:
+            upsert_users_seen_bulk(list(users.values()), db_path=db)
+        except Exception as e:
+            print("user_seen flush failed:", e)
+
+
+def _event_writer_loop() -> None:
+    users_flushed_at = time.monotonic()
+    while True:
+        try:
+            batch = [_EVENT_Q.get(timeout=_USER_SEEN_FLUSH_INTERVAL)]
+        except queue.Empty:
+            batch = []
+        if batch:
+            deadline = time.monotonic() + _EVENT_FLUSH_INTERVAL
+            while len(batch) < _EVENT_BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(_EVENT_Q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            _write_event_batch(batch)
+            for _ in batch:
+                _EVENT_Q.task_done()
+
+        now = time.monotonic()
+        if now - users_flushed_at >= _USER_SEEN_FLUSH_INTERVAL:
+            users_flushed_at = now
+            _flush_pending_users()
+
+
+def _ensure_event_writer() -> None:
+    global _event_writer
+    if _event_writer is None:
+        with _EVENT_WRITER_LOCK:
+            if _event_writer is None:
+                _event_writer = threading.Thread(target=_event_writer_loop, name="events-writer", daemon=True)
+                _event_writer.start()
+                atexit.register(flush)
+
+
+def flush() -> None:
+    # Blocks until every user_seen update and event queued so far has been written
+    # (or dropped on error).
+    _flush_pending_users()
+    if _event_writer is not None:
+        _EVENT_Q.join()
+
+
+def mark_user_seen(user: TgUserInfo, db_path: str | None = None) -> None:
+    db = db_path or _default_db_path()
+    with _PENDING_LOCK:
+        _pending_users.setdefault(db, {})[user.user_id] = user
+    _ensure_event_writer()
 
 
 def log_event(
@@ -207,390 +644,217 @@ def log_event(
 ) -> None:
     db = db_path or _default_db_path()
     now_ts = int(ts or time.time())
+    _ensure_event_writer()
+    _EVENT_Q.put((db, (now_ts, user_id, event, _EVENT_ID.get(event), message_id, effect, video_duration, video_file_size, error)))
+
+
+def _ban_cache_put(user_id: int, banned: bool) -> None:
+    with _BAN_CACHE_LOCK:
+        _ban_cache[user_id] = (banned, time.monotonic())
+        _ban_cache.move_to_end(user_id)
+        if len(_ban_cache) > _BAN_CACHE_MAX:
+            _ban_cache.popitem(last=False)
 
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor()
-                cur.execute(
-                    """
-                    INSERT INTO events(ts, user_id, event, message_id, effect, video_duration, video_file_size, error)
-                    VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (now_ts, user_id, event, message_id, effect, video_duration, video_file_size, error),
-                )
-                conn.commit()
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                conn.execute(
-                    """
-                    INSERT INTO events(ts, user_id, event, message_id, effect, video_duration, video_file_size, error)
-                    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (now_ts, user_id, event, message_id, effect, video_duration, video_file_size, error),
-                )
-                conn.commit()
-            finally:
-                conn.close()
+
+def is_banned_cached(user_id: int) -> bool | None:
+    with _BAN_CACHE_LOCK:
+        cached = _ban_cache.get(user_id)
+        if cached is not None:
+            _ban_cache.move_to_end(user_id)
+    if cached is not None and time.monotonic() - cached[1] < _BAN_CACHE_TTL:
+        return cached[0]
+    return None
 
 
 def is_banned(user_id: int, db_path: str | None = None) -> bool:
+    cached = is_banned_cached(user_id)
+    if cached is not None:
+        return cached
+
+    banned = _is_banned_db(user_id, db_path)
+    _ban_cache_put(user_id, banned)
+    return banned
+
+
+def _is_banned_db(user_id: int, db_path: str | None = None) -> bool:
     db = db_path or _default_db_path()
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute("SELECT is_banned FROM users WHERE user_id = %s", (user_id,))
-                row = cur.fetchone()
-                if row is None:
-                    return False
-                return bool(row["is_banned"])
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                row = conn.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,)).fetchone()
-                if row is None:
-                    return False
-                return bool(row["is_banned"])
-            finally:
-                conn.close()
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            _pg_prepare(conn)
+            cur = conn.cursor()
+            cur.execute("EXECUTE p_is_banned(%s)", (user_id,))
+            row = cur.fetchone()
+            if row is None:
+                return False
+            return bool(row[0])
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        row = conn.execute(_SQL_IS_BANNED_SQLITE, (user_id,)).fetchone()
+        if row is None:
+            return False
+        return bool(row[0])
 
 
 def set_banned(user_id: int, banned: bool, db_path: str | None = None) -> None:
     db = db_path or _default_db_path()
     now_ts = int(time.time())
-    with _DB_LOCK:
+    with _WRITE_LOCK:
         if _is_postgres():
             conn = _pg_connect()
             try:
                 cur = conn.cursor()
-                cur.execute(
-                    """
-                    INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
-                    VALUES(%s, NULL, NULL, %s, %s, %s)
-                    ON CONFLICT (user_id) DO UPDATE
-                    SET is_banned = EXCLUDED.is_banned,
-                        last_seen_ts = GREATEST(users.last_seen_ts, EXCLUDED.last_seen_ts)
-                    """,
-                    (user_id, now_ts, now_ts, banned),
-                )
+                cur.execute(_SQL_SET_BANNED_PG, (user_id, now_ts, now_ts, banned))
                 conn.commit()
             finally:
-                conn.close()
+                _pg_return(conn)
         else:
-            conn = _connect(db)
-            try:
-                row = conn.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,)).fetchone()
-                if row is None:
-                    conn.execute(
-                        """
-                        INSERT INTO users(user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned)
-                        VALUES(?, NULL, NULL, ?, ?, ?)
-                        """,
-                        (user_id, now_ts, now_ts, 1 if banned else 0),
-                    )
-                else:
-                    conn.execute(
-                        "UPDATE users SET is_banned = ? WHERE user_id = ?",
-                        (1 if banned else 0, user_id),
-                    )
-                conn.commit()
-            finally:
-                conn.close()
+            with _sqlite_write(db) as conn:
+                conn.execute(_SQL_SET_BANNED_SQLITE, (user_id, now_ts, now_ts, 1 if banned else 0))
 
+    _ban_cache_put(user_id, banned)
 
-def _day_bounds_ts_local(day: datetime) -> tuple[int, int]:
-    start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start.replace(hour=23, minute=59, second=59, microsecond=999999)
-    return int(start.timestamp()), int(end.timestamp())
 
+@lru_cache(maxsize=1)
+def _day_bounds_ts_local(year: int, month: int, day: int) -> tuple[int, int]:
+    # Each end is converted on its own so DST-change days get their real length.
+    start = time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+    end = time.mktime((year, month, day, 23, 59, 59, 0, 0, -1))
+    return int(start), int(end)
 
-def stats_today(db_path: str | None = None) -> dict[str, int]:
-    db = db_path or _default_db_path()
-    today = datetime.now()
-    start_ts, end_ts = _day_bounds_ts_local(today)
 
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute("SELECT COUNT(*) AS c FROM users")
-                total_users = cur.fetchone()["c"]
-                cur.execute("SELECT COUNT(*) AS c FROM users WHERE first_seen_ts BETWEEN %s AND %s", (start_ts, end_ts))
-                new_users = cur.fetchone()["c"]
-                cur.execute(
-                    "SELECT COUNT(DISTINCT user_id) AS c FROM events WHERE event = 'user_seen' AND ts BETWEEN %s AND %s",
-                    (start_ts, end_ts),
-                )
-                active_users = cur.fetchone()["c"]
-                cur.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_start' AND ts BETWEEN %s AND %s",
-                    (start_ts, end_ts),
-                )
-                videos_started = cur.fetchone()["c"]
-                cur.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_success' AND ts BETWEEN %s AND %s",
-                    (start_ts, end_ts),
-                )
-                videos_success = cur.fetchone()["c"]
-                cur.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_error' AND ts BETWEEN %s AND %s",
-                    (start_ts, end_ts),
-                )
-                videos_error = cur.fetchone()["c"]
-
-                return {
-                    "total_users": int(total_users),
-                    "new_users_today": int(new_users),
-                    "active_users_today": int(active_users),
-                    "videos_started_today": int(videos_started),
-                    "videos_success_today": int(videos_success),
-                    "videos_error_today": int(videos_error),
-                }
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                total_users = conn.execute("SELECT COUNT(*) AS c FROM users").fetchone()["c"]
-                new_users = conn.execute(
-                    "SELECT COUNT(*) AS c FROM users WHERE first_seen_ts BETWEEN ? AND ?",
-                    (start_ts, end_ts),
-                ).fetchone()["c"]
-                active_users = conn.execute(
-                    "SELECT COUNT(DISTINCT user_id) AS c FROM events WHERE event = 'user_seen' AND ts BETWEEN ? AND ?",
-                    (start_ts, end_ts),
-                ).fetchone()["c"]
-                videos_started = conn.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_start' AND ts BETWEEN ? AND ?",
-                    (start_ts, end_ts),
-                ).fetchone()["c"]
-                videos_success = conn.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_success' AND ts BETWEEN ? AND ?",
-                    (start_ts, end_ts),
-                ).fetchone()["c"]
-                videos_error = conn.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE event = 'video_error' AND ts BETWEEN ? AND ?",
-                    (start_ts, end_ts),
-                ).fetchone()["c"]
-
-                return {
-                    "total_users": int(total_users),
-                    "new_users_today": int(new_users),
-                    "active_users_today": int(active_users),
-                    "videos_started_today": int(videos_started),
-                    "videos_success_today": int(videos_success),
-                    "videos_error_today": int(videos_error),
-                }
-            finally:
-                conn.close()
+def _day_start_ts_local(ts: int) -> int:
+    t = time.localtime(ts)
+    return _day_bounds_ts_local(t.tm_year, t.tm_mon, t.tm_mday)[0]
 
 
-def users_today(limit: int = 50, db_path: str | None = None) -> list[dict]:
-    db = db_path or _default_db_path()
-    today = datetime.now()
-    start_ts, end_ts = _day_bounds_ts_local(today)
-
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT user_id, username, full_name, first_seen_ts, last_seen_ts
-                    FROM users
-                    WHERE first_seen_ts BETWEEN %s AND %s
-                    ORDER BY first_seen_ts DESC
-                    LIMIT %s
-                    """,
-                    (start_ts, end_ts, limit),
-                )
-                return [dict(r) for r in cur.fetchall()]
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                rows = conn.execute(
-                    """
-                    SELECT user_id, username, full_name, first_seen_ts, last_seen_ts
-                    FROM users
-                    WHERE first_seen_ts BETWEEN ? AND ?
-                    ORDER BY first_seen_ts DESC
-                    LIMIT ?
-                    """,
-                    (start_ts, end_ts, limit),
-                ).fetchall()
-                return [dict(r) for r in rows]
-            finally:
-                conn.close()
+def _today_bounds_ts_local() -> tuple[int, int]:
+    now = time.localtime()
+    return _day_bounds_ts_local(now.tm_year, now.tm_mon, now.tm_mday)
 
 
-def videos_today(limit: int = 50, db_path: str | None = None) -> list[dict]:
+def stats_today(db_path: str | None = None) -> dict[str, int]:
     db = db_path or _default_db_path()
-    today = datetime.now()
-    start_ts, end_ts = _day_bounds_ts_local(today)
-
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT ts, user_id, event, effect, video_duration, video_file_size, error, message_id
-                    FROM events
-                    WHERE event IN ('video_start', 'video_success', 'video_error')
-                      AND ts BETWEEN %s AND %s
-                    ORDER BY ts DESC
-                    LIMIT %s
-                    """,
-                    (start_ts, end_ts, limit),
-                )
-                return [dict(r) for r in cur.fetchall()]
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                rows = conn.execute(
-                    """
-                    SELECT ts, user_id, event, effect, video_duration, video_file_size, error, message_id
-                    FROM events
-                    WHERE event IN ('video_start', 'video_success', 'video_error')
-                      AND ts BETWEEN ? AND ?
-                    ORDER BY ts DESC
-                    LIMIT ?
-                    """,
-                    (start_ts, end_ts, limit),
-                ).fetchall()
-                return [dict(r) for r in rows]
-            finally:
-                conn.close()
+    start_ts, end_ts = _today_bounds_ts_local()
+
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(_SQL_STATS_TODAY_PG, (start_ts, end_ts, start_ts, end_ts))
+            row = cur.fetchone()
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        row = conn.execute(_SQL_STATS_TODAY_SQLITE, (start_ts, end_ts, start_ts, end_ts)).fetchone()
+
+    # SUM() over zero rows is NULL in SQLite.
+    total_users, new_users, active_users, videos_started, videos_success, videos_error = row
+    return {
+        "total_users": int(total_users),
+        "new_users_today": int(new_users),
+        "active_users_today": int(active_users),
+        "videos_started_today": int(videos_started or 0),
+        "videos_success_today": int(videos_success or 0),
+        "videos_error_today": int(videos_error or 0),
+    }
+
+
+def users_today(
+    limit: int = 50, db_path: str | None = None, after: tuple[int, int] | None = None
+) -> list[UserRow]:
+    db = db_path or _default_db_path()
+    start_ts, end_ts = _today_bounds_ts_local()
+    if after is None:
+        sql_pg, sql_sqlite, params = _SQL_USERS_TODAY_PG, _SQL_USERS_TODAY_SQLITE, (start_ts, end_ts, limit)
+    else:
+        sql_pg, sql_sqlite = _SQL_USERS_TODAY_AFTER_PG, _SQL_USERS_TODAY_AFTER_SQLITE
+        params = (start_ts, end_ts, after[0], after[1], limit)
+
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql_pg, params)
+            return list(map(UserRow._make, cur.fetchall()))
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        rows = conn.execute(sql_sqlite, params).fetchall()
+        return list(map(UserRow._make, rows))
+
+
+def videos_today(
+    limit: int = 50, db_path: str | None = None, after: tuple[int, int] | None = None
+) -> list[VideoRow]:
+    db = db_path or _default_db_path()
+    start_ts, end_ts = _today_bounds_ts_local()
+    if after is None:
+        sql_pg, sql_sqlite, params = _SQL_VIDEOS_TODAY_PG, _SQL_VIDEOS_TODAY_SQLITE, (start_ts, end_ts, limit)
+    else:
+        sql_pg, sql_sqlite = _SQL_VIDEOS_TODAY_AFTER_PG, _SQL_VIDEOS_TODAY_AFTER_SQLITE
+        params = (start_ts, end_ts, after[0], after[1], limit)
+
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql_pg, params)
+            return list(map(VideoRow._make, cur.fetchall()))
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        rows = conn.execute(sql_sqlite, params).fetchall()
+        return list(map(VideoRow._make, rows))
+
+
+def _user_card_from_row(row) -> dict[str, object]:
+    return {
+        "user_id": int(row[0]),
+        "username": row[1],
+        "full_name": row[2],
+        "first_seen_ts": int(row[3]),
+        "last_seen_ts": int(row[4]),
+        "is_banned": bool(row[5]),
+        "videos_success": int(row[6]),
+        "videos_error": int(row[7]),
+    }
 
 
 def user_card(user_id: int, db_path: str | None = None) -> dict[str, object] | None:
     db = db_path or _default_db_path()
 
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned
-                    FROM users
-                    WHERE user_id = %s
-                    """,
-                    (user_id,),
-                )
-                u = cur.fetchone()
-                if u is None:
-                    return None
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(_SQL_USER_CARD_PG, (user_id,))
+            row = cur.fetchone()
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        row = conn.execute(_SQL_USER_CARD_SQLITE, (user_id,)).fetchone()
 
-                cur.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE user_id = %s AND event = 'video_success'",
-                    (user_id,),
-                )
-                video_success = cur.fetchone()["c"]
-                cur.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE user_id = %s AND event = 'video_error'",
-                    (user_id,),
-                )
-                video_error = cur.fetchone()["c"]
-
-                return {
-                    "user_id": int(u["user_id"]),
-                    "username": u["username"],
-                    "full_name": u["full_name"],
-                    "first_seen_ts": int(u["first_seen_ts"]),
-                    "last_seen_ts": int(u["last_seen_ts"]),
-                    "is_banned": bool(u["is_banned"]),
-                    "videos_success": int(video_success),
-                    "videos_error": int(video_error),
-                }
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                u = conn.execute(
-                    """
-                    SELECT user_id, username, full_name, first_seen_ts, last_seen_ts, is_banned
-                    FROM users
-                    WHERE user_id = ?
-                    """,
-                    (user_id,),
-                ).fetchone()
-                if u is None:
-                    return None
-
-                video_success = conn.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE user_id = ? AND event = 'video_success'",
-                    (user_id,),
-                ).fetchone()["c"]
-                video_error = conn.execute(
-                    "SELECT COUNT(*) AS c FROM events WHERE user_id = ? AND event = 'video_error'",
-                    (user_id,),
-                ).fetchone()["c"]
-
-                return {
-                    "user_id": int(u["user_id"]),
-                    "username": u["username"],
-                    "full_name": u["full_name"],
-                    "first_seen_ts": int(u["first_seen_ts"]),
-                    "last_seen_ts": int(u["last_seen_ts"]),
-                    "is_banned": bool(u["is_banned"]),
-                    "videos_success": int(video_success),
-                    "videos_error": int(video_error),
-                }
-            finally:
-                conn.close()
+    return _user_card_from_row(row) if row is not None else None
 
 
-def banned_users(limit: int = 50, db_path: str | None = None) -> list[dict]:
+def banned_users(limit: int = 50, db_path: str | None = None) -> list[BannedRow]:
     db = db_path or _default_db_path()
-    with _DB_LOCK:
-        if _is_postgres():
-            conn = _pg_connect()
-            try:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT user_id, username, full_name, last_seen_ts
-                    FROM users
-                    WHERE is_banned = TRUE
-                    ORDER BY last_seen_ts DESC
-                    LIMIT %s
-                    """,
-                    (limit,),
-                )
-                return [dict(r) for r in cur.fetchall()]
-            finally:
-                conn.close()
-        else:
-            conn = _connect(db)
-            try:
-                rows = conn.execute(
-                    """
-                    SELECT user_id, username, full_name, last_seen_ts
-                    FROM users
-                    WHERE is_banned = 1
-                    ORDER BY last_seen_ts DESC
-                    LIMIT ?
-                    """,
-                    (limit,),
-                ).fetchall()
-                return [dict(r) for r in rows]
-            finally:
-                conn.close()
+    if _is_postgres():
+        conn = _pg_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(_SQL_BANNED_USERS_PG, (limit,))
+            return list(map(BannedRow._make, cur.fetchall()))
+        finally:
+            _pg_return(conn)
+    else:
+        conn = _get_sqlite_read_conn(db)
+        rows = conn.execute(_SQL_BANNED_USERS_SQLITE, (limit,)).fetchall()
+        return list(map(BannedRow._make, rows))
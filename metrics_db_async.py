@@ -0,0 +1,45 @@
+import asyncio
+
+import metrics_db
+
+
+# metrics_db is synchronous (sqlite3 / psycopg2). Queries and ban updates run in the
+# default thread pool so a slow query never stalls the aiogram event loop; log_event only
+# enqueues and is called directly, and is_banned goes to a thread only on a cache miss.
+
+
+async def log_event(user_id: int, event: str, **kwargs) -> None:
+    # Only enqueues for the events writer thread, so no thread hop is needed.
+    metrics_db.log_event(user_id, event, **kwargs)
+
+
+async def is_banned(user_id: int) -> bool:
+    # Most checks hit the ban cache; only a miss pays for the thread hop.
+    cached = metrics_db.is_banned_cached(user_id)
+    if cached is not None:
+        return cached
+    return await asyncio.to_thread(metrics_db.is_banned, user_id)
+
+
+async def set_banned(user_id: int, banned: bool) -> None:
+    await asyncio.to_thread(metrics_db.set_banned, user_id, banned)
+
+
+async def stats_today() -> dict[str, int]:
+    return await asyncio.to_thread(metrics_db.stats_today)
+
+
+async def users_today(limit: int = 50, after: tuple[int, int] | None = None) -> list[metrics_db.UserRow]:
+    return await asyncio.to_thread(metrics_db.users_today, limit, after=after)
+
+
+async def videos_today(limit: int = 50, after: tuple[int, int] | None = None) -> list[metrics_db.VideoRow]:
+    return await asyncio.to_thread(metrics_db.videos_today, limit, after=after)
+
+
+async def user_card(user_id: int) -> dict[str, object] | None:
+    return await asyncio.to_thread(metrics_db.user_card, user_id)
+
+
+async def banned_users(limit: int = 50) -> list[metrics_db.BannedRow]:
+    return await asyncio.to_thread(metrics_db.banned_users, limit)
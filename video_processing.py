@@ -1,11 +1,17 @@
 import asyncio
 import collections
+import contextlib
+import json
 import os
-import re
 import random
+import shlex
+import subprocess
+import tempfile
 import time
 import uuid
+from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple
 
 from aiogram.types import Message, FSInputFile
 from aiogram.exceptions import TelegramBadRequest
@@ -13,37 +19,158 @@ from aiogram.exceptions import TelegramBadRequest
 import metrics_db
 
 
-async def get_duration(path: str) -> float:
-    cmd = (
-        f"ffprobe -v error -show_entries format=duration "
-        f"-of default=noprint_wrappers=1:nokey=1 \"{path}\""
-    )
-    process = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL
-    )
-    stdout, _ = await process.communicate()
-    return float(stdout.decode().strip())
+# Concurrent ffmpeg jobs; each job gets an equal share of the cores so the total stays <= cpu count.
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", "0")) or max(1, (os.cpu_count() or 1) // 2)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // FFMPEG_CONCURRENCY)
+
+X264_PRESET = os.getenv("X264_PRESET", "superfast")
+X264_ARGS = (
+    "-c:v", "libx264", "-preset", X264_PRESET, "-tune", "fastdecode,zerolatency", "-crf", "26",
+    "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+    "-threads", str(FFMPEG_THREADS), "-x264-params", "sliced-threads=1",
+)
+FILTER_THREADS = FFMPEG_THREADS
+FILTER_THREAD_ARGS = ("-filter_threads", str(FILTER_THREADS), "-filter_complex_threads", str(FILTER_THREADS))
+AAC_ARGS = ("-c:a", "aac", "-b:a", "96k")
+
+
+# Per-request input/output files. Defaults to the working directory; point VIDEO_TMP_DIR at a
+# tmpfs such as /dev/shm only if it is sized for every queued download plus running encodes
+# (Docker's default /dev/shm is 64 MB).
+TMP_DIR = os.getenv("VIDEO_TMP_DIR", "").strip()
+_DOWNLOAD_CHUNK = 1024 * 1024
+
+# Structured key=value progress on stdout instead of scraping the stderr stats line.
+PROGRESS_ARGS = ("-nostats", "-progress", "pipe:1")
+_OUT_TIME_US = b"out_time_us="
+
+_HW_ENCODER_ARGS = {
+    "h264_nvenc": (
+        "-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll", "-rc", "vbr", "-cq", "26", "-b:v", "0",
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+    ),
+    "h264_qsv": (
+        "-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "26",
+        "-pix_fmt", "nv12", "-movflags", "+faststart",
+    ),
+    "h264_videotoolbox": (
+        "-c:v", "h264_videotoolbox", "-q:v", "55", "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+    ),
+}
+
+
+def _hw_encoder_works(name: str) -> bool:
+    # Being compiled in is not enough: the device/driver must be present too, so run a tiny encode.
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-v", "error", "-f", "lavfi", "-i", "color=s=256x256:d=0.1",
+             *_HW_ENCODER_ARGS[name], "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=10,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return result.returncode == 0
 
 
-async def has_audio(path: str) -> bool:
-    cmd = (
-        f"ffprobe -v error -select_streams a:0 -show_entries stream=codec_type "
-        f"-of default=noprint_wrappers=1:nokey=1 \"{path}\""
-    )
-    process = await asyncio.create_subprocess_shell(
-        cmd,
+def _detect_video_args() -> tuple[str, ...]:
+    wanted = os.getenv("VIDEO_ENCODER", "auto").strip()
+    if wanted == "libx264":
+        return X264_ARGS
+    try:
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=10,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return X264_ARGS
+    for name in _HW_ENCODER_ARGS:
+        if wanted not in ("auto", name) or f" {name} " not in encoders:
+            continue
+        if _hw_encoder_works(name):
+            print("video encoder:", name)
+            return _HW_ENCODER_ARGS[name]
+    return X264_ARGS
+
+
+@lru_cache(maxsize=1)
+def video_args() -> tuple[str, ...]:
+    # Detection spawns ffmpeg up to four times, so main() primes this off the event loop at startup.
+    return _detect_video_args()
+
+
+class ProbeInfo(NamedTuple):
+    duration: float
+    with_audio: bool
+    video_codec: str | None
+    pix_fmt: str | None
+    width: int
+    height: int
+
+
+async def probe(path: str) -> ProbeInfo:
+    # One ffprobe run for the container duration, the audio presence and the video stream layout.
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration:stream=codec_type,codec_name,pix_fmt,width,height", "-of", "json", path,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.DEVNULL,
     )
     stdout, _ = await process.communicate()
-    return bool(stdout.decode().strip())
+    info = json.loads(stdout or b"{}")
+    streams = info.get("streams") or []
+    video = next((st for st in streams if st.get("codec_type") == "video"), {})
+    return ProbeInfo(
+        duration=float(info["format"]["duration"]),
+        with_audio=any(st.get("codec_type") == "audio" for st in streams),
+        video_codec=video.get("codec_name"),
+        pix_fmt=video.get("pix_fmt"),
+        width=int(video.get("width") or 0),
+        height=int(video.get("height") or 0),
+    )
 
 
-def progress_bar(percent: int, size: int = 10) -> str:
-    filled = int(size * percent / 100)
-    return "▓" * filled + "░" * (size - filled)
+_BARS = tuple("▓" * i + "░" * (10 - i) for i in range(11))
+
+
+def progress_bar(percent: int) -> str:
+    return _BARS[int(percent) // 10]
+
+
+async def _drain_stderr(stream, tail: collections.deque[str]) -> None:
+    while line := await stream.readline():
+        tail.append(line.decode(errors="replace").strip())
+
+
+async def _pump_progress(process, status_msg, total: float) -> None:
+    last_update = 0.0
+    # The status message already shows 0%.
+    last_percent = 0
+    # -progress writes a block of key=value lines per update, so each read wakes us only for new data.
+    while line := await process.stdout.readline():
+        if not line.startswith(_OUT_TIME_US):
+            continue
+        value = line.removeprefix(_OUT_TIME_US)
+        if not value[:1].isdigit():
+            continue
+        percent = min(int(int(value) / 1_000_000 / total * 100), 100)
+        now = time.monotonic()
+        # обновление не чаще 1 раза в секунду и только если процент изменился
+        if percent != last_percent and now - last_update >= 1:
+            await _safe_edit_status(status_msg, f"⏳ Обрабатываю видео…\n{progress_bar(percent)} {percent}%")
+            last_update = now
+            last_percent = percent
+    await process.wait()
+
+
+def _remove_files(*paths: str) -> None:
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
 
 
 async def _safe_edit_status(status_msg, text: str) -> None:
@@ -57,14 +184,103 @@ async def _safe_edit_status(status_msg, text: str) -> None:
         raise
 
 
-def _build_ffmpeg_cmd(input_file: str, output_file: str, duration: float, effect: str, *, with_audio: bool) -> str:
-    effective_duration = min(duration, 60.0)
+_BASE = "crop='min(iw,ih)':'min(iw,ih)',scale=480:480"
+
+# Filter-graph templates; only the per-request timings are filled in with str.format.
+_SPEED_SLOW_PTS = (
+    "if(lt(X,{t1}),X,"
+    "if(lt(X,{t1_end}),{t1}+(X-{t1})/2,"
+    "if(lt(X,{t2}),X-{saved},"
+    "if(lt(X,{t2_end}),{t2}-{saved}+(X-{t2})*2,"
+    "X-{saved}+{slow_len}))))"
+).replace("X", "(T-STARTT)")
+_SPEED_SLOW_FC = (
+    "[0:v]" + _BASE + ",setpts='({pts})/TB'[v];"
+    "[0:a]asplit=5[a0][a1][a2][a3][a4];"
+    "[a0]atrim=0:{t1},asetpts=PTS-STARTPTS[a0t];"
+    "[a1]atrim={t1}:{t1_end},asetpts=PTS-STARTPTS,atempo=2[a1t];"
+    "[a2]atrim={t1_end}:{t2},asetpts=PTS-STARTPTS[a2t];"
+    "[a3]atrim={t2}:{t2_end},asetpts=PTS-STARTPTS,atempo=0.5[a3t];"
+    "[a4]atrim={t2_end}:{effective_duration},asetpts=PTS-STARTPTS[a4t];"
+    "[a0t][a1t][a2t][a3t][a4t]concat=n=5:v=0:a=1[a]"
+)
+_FLASH_FC = (
+    "[0:v]" + _BASE + ",trim=0:{effective_duration},setpts=PTS-STARTPTS[v0];"
+    "[1:v]{flash_prep}trim=0:{flash_len},setpts=PTS-STARTPTS[fv];"
+    "[v0][fv]overlay=0:0:enable='between(t,{flash_start},{flash_end})'[v]"
+)
+_SPEED_FC = (
+    "[0:v]" + _BASE + ",split=2[v0][v1];"
+    "[v0]trim=0:{end_start},setpts=PTS-STARTPTS[v0t];"
+    "[v1]trim={end_start}:{effective_duration},setpts=(PTS-STARTPTS)/2[v1t];"
+    "[v0t][v1t]concat=n=2:v=1:a=0[v];"
+    "[0:a]asplit=2[a0][a1];"
+    "[a0]atrim=0:{end_start},asetpts=PTS-STARTPTS[a0t];"
+    "[a1]atrim={end_start}:{effective_duration},asetpts=PTS-STARTPTS,atempo=2[a1t];"
+    "[a0t][a1t]concat=n=2:v=0:a=1[a]"
+)
+_SHAKE_VF = (
+    _BASE + ",rotate=0.04*sin(60*t):c=black@0:enable='gte(t,{end_start})',"
+    "gblur=sigma=8:steps=2:enable='gte(t,{end_start})'"
+)
+_ECHO_AF = ("-af", "aecho=0.8:0.9:1000|1800:0.35|0.25")
+# Inputs: 0 = original before the insert point, 1 = original after it, 2 = meme clip. Each leg is
+# decoded from its own -ss/-t input, so nothing has to be buffered by a split.
+_MEME_FC = (
+    "[0:v]" + _BASE + ",setpts=PTS-STARTPTS[vpre];"
+    "[2:v]{meme_prep}trim=0:{meme_len},setpts=PTS-STARTPTS[mv];"
+    "[1:v]" + _BASE + ",setpts=PTS-STARTPTS[vpost];"
+    "[vpre][mv][vpost]concat=n=3:v=1:a=0[v];"
+    "[0:a]asetpts=PTS-STARTPTS[apre];"
+    "[2:a]atrim=0:{meme_len},asetpts=PTS-STARTPTS[ma];"
+    "[1:a]asetpts=PTS-STARTPTS[apost];"
+    "[apre][ma][apost]concat=n=3:v=0:a=1[a]"
+)
+
+# Effects whose command does not depend on the exact duration or audio layout: they are built
+# without probing and rely on -t 60 plus ffmpeg's default stream selection.
+_NO_PROBE_EFFECTS = frozenset({"normal", "echo"})
+
+# Telegram video notes are square and at most 640 px across.
+_MAX_NOTE_SIDE = 640
+_REMUX_PIX_FMTS = frozenset({"yuv420p", "yuvj420p"})
+
+
+def _maybe_remuxable(video) -> bool:
+    # Telegram's own metadata decides whether a "normal" request is worth probing for a remux.
+    width, height = video.width or 0, video.height or 0
+    return 0 < width <= _MAX_NOTE_SIDE and width == height and (video.duration or 0) <= 60
+
+
+def _can_remux(info: ProbeInfo) -> bool:
+    return (
+        info.video_codec == "h264"
+        # 8-bit 4:2:0 only: 10-bit or 4:2:2/4:4:4 H.264 does not play in many clients.
+        and info.pix_fmt in _REMUX_PIX_FMTS
+        and 0 < info.width <= _MAX_NOTE_SIDE
+        and info.width == info.height
+        and info.duration <= 60.0
+    )
+
+
+def _build_remux_cmd(input_file: str, output_file: str) -> list[str]:
+    # Already a square H.264 clip: copy the video bitstream, only (re)encode the cheap audio.
+    return [
+        "ffmpeg", "-y", *PROGRESS_ARGS, "-i", input_file,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "copy", *AAC_ARGS, "-movflags", "+faststart",
+        output_file,
+    ]
+
+
+def _build_ffmpeg_cmd(
+    input_file: str, output_file: str, duration: float | None, effect: str, *, with_audio: bool | None
+) -> list[str]:
+    effective_duration = min(duration, 60.0) if duration is not None else 60.0
     out_duration = effective_duration
     end_start = max(effective_duration - 2.0, 0.0)
     meme_start = max(effective_duration - 0.5, 0.0)
 
-    base = "crop='min(iw,ih)':'min(iw,ih)',scale=480:480"
-
     if effect == "speed_slow":
         if effective_duration < 3.0:
             effect = "normal"
@@ -83,29 +299,23 @@ def _build_ffmpeg_cmd(input_file: str, output_file: str, duration: float, effect
                 t2 = min(t1 + seg_len, max_start)
 
             t1_end = min(t1 + seg_len, effective_duration)
+            # Segments must not overlap for the piecewise time mapping below.
+            t2 = max(t2, t1_end)
             t2_end = min(t2 + seg_len, effective_duration)
+            saved = (t1_end - t1) / 2
 
-            fc = (
-                f"[0:v]{base},split=5[v0][v1][v2][v3][v4];"
-                f"[v0]trim=0:{t1},setpts=PTS-STARTPTS[v0t];"
-                f"[v1]trim={t1}:{t1_end},setpts=(PTS-STARTPTS)/2[v1t];"
-                f"[v2]trim={t1_end}:{t2},setpts=PTS-STARTPTS[v2t];"
-                f"[v3]trim={t2}:{t2_end},setpts=(PTS-STARTPTS)*2[v3t];"
-                f"[v4]trim={t2_end}:{effective_duration},setpts=PTS-STARTPTS[v4t];"
-                f"[v0t][v1t][v2t][v3t][v4t]concat=n=5:v=1:a=0[v];"
-                f"[0:a]asplit=5[a0][a1][a2][a3][a4];"
-                f"[a0]atrim=0:{t1},asetpts=PTS-STARTPTS[a0t];"
-                f"[a1]atrim={t1}:{t1_end},asetpts=PTS-STARTPTS,atempo=2[a1t];"
-                f"[a2]atrim={t1_end}:{t2},asetpts=PTS-STARTPTS[a2t];"
-                f"[a3]atrim={t2}:{t2_end},asetpts=PTS-STARTPTS,atempo=0.5[a3t];"
-                f"[a4]atrim={t2_end}:{effective_duration},asetpts=PTS-STARTPTS[a4t];"
-                f"[a0t][a1t][a2t][a3t][a4t]concat=n=5:v=0:a=1[a]"
-            )
-            return (
-                f"ffmpeg -y -i \"{input_file}\" "
-                f"-filter_complex \"{fc}\" -map \"[v]\" -map \"[a]\" "
-                f"-t {out_duration} -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k \"{output_file}\""
+            # One pass over the decoded frames: map input time to output time piecewise
+            # (x2 speed on [t1, t1_end), x0.5 on [t2, t2_end)) instead of split/trim/concat.
+            times = dict(
+                t1=t1, t1_end=t1_end, t2=t2, t2_end=t2_end, saved=saved, slow_len=t2_end - t2,
+                effective_duration=effective_duration,
             )
+            fc = _SPEED_SLOW_FC.format(pts=_SPEED_SLOW_PTS.format_map(times), **times)
+            return [
+                "ffmpeg", "-y", *PROGRESS_ARGS, *FILTER_THREAD_ARGS, "-i", input_file,
+                "-filter_complex", fc, "-map", "[v]", "-map", "[a]",
+                "-t", str(out_duration), *video_args(), *AAC_ARGS, output_file,
+            ]
 
     if effect == "flash":
         if not with_audio:
@@ -116,75 +326,68 @@ def _build_ffmpeg_cmd(input_file: str, output_file: str, duration: float, effect
             flash_start = random.uniform(0.0, flash_max_start) if flash_max_start > 0 else 0.0
             flash_end = min(flash_start + flash_len, effective_duration)
 
-            flash_file = Path(__file__).resolve().parent / "flesh-bang.mp4"
-            if not flash_file.exists():
+            if not _FLASH_FILE.exists():
                 return _build_ffmpeg_cmd(input_file, output_file, duration, "normal", with_audio=with_audio)
 
-            flash_file_str = str(flash_file)
+            cached = _cached_clip(_FLASH_FILE)
+            flash_file_str = str(cached or _FLASH_FILE)
+            flash_prep = "" if cached else _BASE + ","
 
             # Overlay only video from the flash clip; keep original audio.
-            fc = (
-                f"[0:v]{base},trim=0:{effective_duration},setpts=PTS-STARTPTS[v0];"
-                f"[1:v]{base},trim=0:{flash_len},setpts=PTS-STARTPTS[fv];"
-                f"[v0][fv]overlay=0:0:enable='between(t,{flash_start},{flash_end})'[v]"
+            fc = _FLASH_FC.format(
+                effective_duration=effective_duration,
+                flash_prep=flash_prep,
+                flash_len=flash_len,
+                flash_start=flash_start,
+                flash_end=flash_end,
             )
 
-            return (
-                f"ffmpeg -y -i \"{input_file}\" -stream_loop -1 -i \"{flash_file_str}\" "
-                f"-filter_complex \"{fc}\" -map \"[v]\" -map 0:a? "
-                f"-t {out_duration} -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k \"{output_file}\""
-            )
+            return [
+                "ffmpeg", "-y", *PROGRESS_ARGS, *FILTER_THREAD_ARGS, "-i", input_file,
+                "-stream_loop", "-1", "-i", flash_file_str,
+                "-filter_complex", fc, "-map", "[v]", "-map", "0:a?",
+                "-t", str(out_duration), *video_args(), *AAC_ARGS, output_file,
+            ]
 
     if effect == "speed":
         if not with_audio:
             effect = "normal"
         else:
-            fc = (
-                f"[0:v]{base},split=2[v0][v1];"
-                f"[v0]trim=0:{end_start},setpts=PTS-STARTPTS[v0t];"
-                f"[v1]trim={end_start}:{effective_duration},setpts=(PTS-STARTPTS)/2[v1t];"
-                f"[v0t][v1t]concat=n=2:v=1:a=0[v];"
-                f"[0:a]asplit=2[a0][a1];"
-                f"[a0]atrim=0:{end_start},asetpts=PTS-STARTPTS[a0t];"
-                f"[a1]atrim={end_start}:{effective_duration},asetpts=PTS-STARTPTS,atempo=2[a1t];"
-                f"[a0t][a1t]concat=n=2:v=0:a=1[a]"
-            )
-            return (
-                f"ffmpeg -y -i \"{input_file}\" "
-                f"-filter_complex \"{fc}\" -map \"[v]\" -map \"[a]\" "
-                f"-t {out_duration} -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k \"{output_file}\""
-            )
+            fc = _SPEED_FC.format(end_start=end_start, effective_duration=effective_duration)
+            return [
+                "ffmpeg", "-y", *PROGRESS_ARGS, *FILTER_THREAD_ARGS, "-i", input_file,
+                "-filter_complex", fc, "-map", "[v]", "-map", "[a]",
+                "-t", str(out_duration), *video_args(), *AAC_ARGS, output_file,
+            ]
 
     if effect == "meme":
         raise RuntimeError("meme effect must be handled by _build_meme_insert_cmd")
 
-    vf = base
-    af = ""
+    vf = _BASE
+    af: tuple[str, ...] = ()
 
     if effect == "echo":
-        af = "-af \"aecho=0.8:0.9:1000|1800:0.35|0.25\" "
+        af = _ECHO_AF
     elif effect == "shake":
-        vf = (
-            f"{vf},rotate=0.04*sin(60*t):c=black@0:enable='gte(t,{end_start})',"
-            f"gblur=sigma=8:steps=2:enable='gte(t,{end_start})'"
-        )
+        vf = _SHAKE_VF.format(end_start=end_start)
 
-    audio_part = ""
-    if with_audio:
-        audio_part = f"{af}-c:a aac -b:a 128k "
+    if with_audio is False:
+        audio_part: tuple[str, ...] = ("-an",)
     else:
-        audio_part = "-an "
+        # Unknown (not probed) is fine too: without an audio stream ffmpeg maps video only.
+        audio_part = (*af, *AAC_ARGS)
 
-    return (
-        f"ffmpeg -y -i \"{input_file}\" "
-        f"-vf \"{vf}\" "
-        f"-t {out_duration} "
-        f"-c:v libx264 -preset veryfast -crf 23 "
-        f"{audio_part}"
-        f"\"{output_file}\""
-    )
+    return [
+        "ffmpeg", "-y", *PROGRESS_ARGS, *FILTER_THREAD_ARGS, "-i", input_file,
+        "-vf", vf,
+        "-t", str(out_duration),
+        *video_args(),
+        *audio_part,
+        output_file,
+    ]
 
 
+@lru_cache(maxsize=1)
 def _get_memes_dir() -> Path | None:
     project_memes_dir = Path(__file__).resolve().parent / "memes"
     if project_memes_dir.exists():
@@ -197,74 +400,163 @@ def _get_memes_dir() -> Path | None:
     return None
 
 
-def _build_meme_insert_cmd(input_file: str, output_file: str, duration: float, *, with_audio: bool) -> str:
+_meme_files_cache: tuple[Path, ...] | None = None
+_meme_files_mtime: int | None = None
+
+
+def _meme_files() -> tuple[Path, ...]:
+    global _meme_files_cache, _meme_files_mtime
+    memes_dir = _get_memes_dir()
+    if memes_dir is None:
+        return ()
+    try:
+        mtime = memes_dir.stat().st_mtime_ns
+    except OSError:
+        return ()
+    # Re-scan only when files were added/removed/renamed (directory mtime changes).
+    if _meme_files_cache is None or mtime != _meme_files_mtime:
+        _meme_files_cache = tuple(sorted(memes_dir.glob("*.mp4")))
+        _meme_files_mtime = mtime
+    return _meme_files_cache
+
+
+# The flash and meme clips never change, so crop/scale them to 480x480 yuv420p once instead of
+# on every request. Until a clip is ready the commands fall back to the original file.
+_FLASH_FILE = Path(__file__).resolve().parent / "flesh-bang.mp4"
+_CLIP_CACHE_DIR = Path(os.getenv("CLIP_CACHE_DIR", "").strip() or Path(tempfile.gettempdir()) / "krujok-clips")
+_CLIP_VF = _BASE + ",format=yuv420p"
+# source path -> (source mtime_ns, prepared copy)
+_clip_cache: dict[str, tuple[int, Path]] = {}
+
+
+async def _prepare_clip(src: Path, *, keep_audio: bool) -> None:
+    try:
+        mtime = src.stat().st_mtime_ns
+    except OSError:
+        return
+    dst = _CLIP_CACHE_DIR / f"{src.stem}.{mtime}.480.mp4"
+    if not dst.exists():
+        tmp = _CLIP_CACHE_DIR / f"{src.stem}.{mtime}.part.mp4"
+        audio = ("-c:a", "aac", "-b:a", "128k") if keep_audio else ("-an",)
+        returncode = None
+        # Shares the encode slots with user jobs instead of competing with them.
+        async with FFMPEG_SEM:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-y", "-v", "error", "-i", str(src), "-vf", _CLIP_VF,
+                    "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-threads", str(FFMPEG_THREADS),
+                    *audio, str(tmp),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+            except OSError:
+                process = None
+            if process is not None:
+                try:
+                    returncode = await asyncio.wait_for(process.wait(), timeout=120)
+                except asyncio.TimeoutError:
+                    print("clip cache: encode timed out:", src)
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+        if returncode != 0:
+            _remove_files(str(tmp))
+            return
+        os.replace(tmp, dst)
+    _clip_cache[str(src)] = (mtime, dst)
+
+
+def _cached_clip(src: Path) -> Path | None:
+    entry = _clip_cache.get(str(src))
+    if entry is None:
+        return None
+    try:
+        if src.stat().st_mtime_ns == entry[0]:
+            return entry[1]
+    except OSError:
+        pass
+    return None
+
+
+async def warm_clip_cache() -> None:
+    # Started by main(); until a clip is ready requests use the original file.
+    try:
+        _CLIP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        print("clip cache disabled:", e)
+        return
+    await _prepare_clip(_FLASH_FILE, keep_audio=False)
+    for meme in _meme_files():
+        await _prepare_clip(meme, keep_audio=True)
+
+
+def _build_meme_insert_cmd(input_file: str, output_file: str, duration: float, *, with_audio: bool) -> list[str]:
     effective_duration = min(duration, 60.0)
     meme_len = 5.0
     out_duration = min(60.0, effective_duration + meme_len)
     if not with_audio:
         return _build_ffmpeg_cmd(input_file, output_file, duration, "normal", with_audio=False)
 
-    memes_dir = _get_memes_dir()
-    meme_files = sorted(memes_dir.glob("*.mp4")) if memes_dir else []
+    meme_files = _meme_files()
     if not meme_files:
         return _build_ffmpeg_cmd(input_file, output_file, duration, "normal", with_audio=with_audio)
 
-    meme_file = str(random.choice(meme_files))
+    meme_path = random.choice(meme_files)
+    cached = _cached_clip(meme_path)
+    meme_file = str(cached or meme_path)
 
-    insert_at = random.uniform(0.0, effective_duration) if effective_duration > 0 else 0.0
+    # Keep both original legs non-empty: a zero-length -t input would stall concat.
+    edge = min(0.1, effective_duration / 4)
+    insert_at = random.uniform(edge, effective_duration - edge)
 
-    base = "crop='min(iw,ih)':'min(iw,ih)',scale=480:480"
+    meme_prep = "" if cached else _BASE + ","
 
     # Insert meme segment (5s) into the video/audio timeline => output duration = original + 5s.
-    # Note: expects audio tracks to exist (0:a and 1:a). If a meme has no audio, ffmpeg may fail.
-    fc = (
-        f"[0:v]{base},trim=0:{effective_duration},setpts=PTS-STARTPTS[v0];"
-        f"[1:v]{base},trim=0:{meme_len},setpts=PTS-STARTPTS[mv];"
-        f"[v0]split=2[vpre][vpost];"
-        f"[vpre]trim=0:{insert_at},setpts=PTS-STARTPTS[vpre_t];"
-        f"[vpost]trim={insert_at}:{effective_duration},setpts=PTS-STARTPTS[vpost_t];"
-        f"[vpre_t][mv][vpost_t]concat=n=3:v=1:a=0[v];"
-        f"[0:a]atrim=0:{effective_duration},asetpts=PTS-STARTPTS[a0];"
-        f"[1:a]atrim=0:{meme_len},asetpts=PTS-STARTPTS[ma];"
-        f"[a0]asplit=2[apre][apost];"
-        f"[apre]atrim=0:{insert_at},asetpts=PTS-STARTPTS[apre_t];"
-        f"[apost]atrim={insert_at}:{effective_duration},asetpts=PTS-STARTPTS[apost_t];"
-        f"[apre_t][ma][apost_t]concat=n=3:v=0:a=1[a]"
-    )
+    # Note: expects audio tracks to exist (original and meme). If a meme has no audio, ffmpeg may fail.
+    fc = _MEME_FC.format(meme_prep=meme_prep, meme_len=meme_len)
 
-    return (
-        f"ffmpeg -y -i \"{input_file}\" -stream_loop -1 -i \"{meme_file}\" "
-        f"-filter_complex \"{fc}\" -map \"[v]\" -map \"[a]\" "
-        f"-t {out_duration} -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k \"{output_file}\""
-    )
+    return [
+        "ffmpeg", "-y", *PROGRESS_ARGS, *FILTER_THREAD_ARGS,
+        "-ss", "0", "-t", str(insert_at), "-i", input_file,
+        "-ss", str(insert_at), "-t", str(effective_duration - insert_at), "-i", input_file,
+        "-stream_loop", "-1", "-i", meme_file,
+        "-filter_complex", fc, "-map", "[v]", "-map", "[a]",
+        "-t", str(out_duration), *video_args(), *AAC_ARGS, output_file,
+    ]
 
 
 async def convert_video_to_circle(message: Message, bot, effect: str = "normal") -> None:
     video = message.video
 
     user_id = message.from_user.id if message.from_user else 0
+    # metrics_db.log_event only enqueues for its batching writer thread, so it is safe to call inline.
+    evt = {
+        "message_id": message.message_id,
+        "effect": effect,
+        "video_duration": float(video.duration) if video.duration is not None else None,
+        "video_file_size": int(video.file_size) if video.file_size is not None else None,
+    }
     if user_id:
-        metrics_db.log_event(
-            user_id,
-            "video_start",
-            message_id=message.message_id,
-            effect=effect,
-            video_duration=float(video.duration) if video.duration is not None else None,
-            video_file_size=int(video.file_size) if video.file_size is not None else None,
-        )
+        metrics_db.log_event(user_id, "video_start", **evt)
 
-    input_file = f"input_{uuid.uuid4()}.mp4"
-    output_file = f"circle_{uuid.uuid4()}.mp4"
+    input_file = os.path.join(TMP_DIR, f"input_{uuid.uuid4()}.mp4")
+    output_file = os.path.join(TMP_DIR, f"circle_{uuid.uuid4()}.mp4")
 
     status_msg = None
     try:
         # 1) скачиваем видео
-        await bot.download(video.file_id, destination=input_file)
+        # aiogram streams straight to the file via aiofiles; 1 MiB chunks keep an 8 MB upload to a
+        # handful of writes instead of ~128 64 KiB ones.
+        await bot.download(video.file_id, destination=input_file, chunk_size=_DOWNLOAD_CHUNK)
 
         # 2) узнаём длительность
-        duration = await get_duration(input_file)
-
-        with_audio = await has_audio(input_file)
+        info = None
+        if effect not in _NO_PROBE_EFFECTS or (effect == "normal" and _maybe_remuxable(video)):
+            info = await probe(input_file)
+        duration = info.duration if info else None
+        with_audio = info.with_audio if info else None
+        progress_total = duration or float(video.duration or 0) or 60.0
 
         # 3) статус-сообщение
         status_msg = await message.answer(
@@ -275,64 +567,42 @@ async def convert_video_to_circle(message: Message, bot, effect: str = "normal")
         # 4) ffmpeg команда
         if effect == "meme":
             cmd = _build_meme_insert_cmd(input_file, output_file, duration, with_audio=with_audio)
+        elif effect == "normal" and info is not None and _can_remux(info):
+            cmd = _build_remux_cmd(input_file, output_file)
         else:
             cmd = _build_ffmpeg_cmd(input_file, output_file, duration, effect, with_audio=with_audio)
 
         # 5) запускаем ffmpeg и читаем прогресс
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE
-        )
-
-        time_regex = re.compile(r"time=(\d+):(\d+):(\d+\.\d+)")
-        last_update = 0
-
-        start_time = time.time()
+        async with FFMPEG_SEM:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
 
-        stderr_tail: collections.deque[str] = collections.deque(maxlen=200)
+            stderr_tail: collections.deque[str] = collections.deque(maxlen=200)
+            stderr_task = asyncio.create_task(_drain_stderr(process.stderr, stderr_tail))
 
-        while True:
-            if time.time() - start_time > 300:
-                process.kill()
-                await process.wait()
+            timed_out = False
+            try:
+                await asyncio.wait_for(_pump_progress(process, status_msg, progress_total), timeout=300)
+            except asyncio.TimeoutError:
+                timed_out = True
+            finally:
+                # Never leave ffmpeg running once we stop reading it (timeout, Telegram errors,
+                # cancellation): the slot is released and the files are unlinked right after.
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                    stderr_task.cancel()
+
+            if timed_out:
                 await _safe_edit_status(status_msg, "❌ Обработка заняла больше 5 минут. Пришли другое видео.")
                 if user_id:
-                    metrics_db.log_event(
-                        user_id,
-                        "video_error",
-                        message_id=message.message_id,
-                        effect=effect,
-                        video_duration=float(video.duration) if video.duration is not None else None,
-                        video_file_size=int(video.file_size) if video.file_size is not None else None,
-                        error="timeout_5m",
-                    )
+                    metrics_db.log_event(user_id, "video_error", **evt, error="timeout_5m")
                 return
 
-            try:
-                line = await asyncio.wait_for(process.stderr.readline(), timeout=1)
-            except asyncio.TimeoutError:
-                continue
-
-            if not line:
-                break
-
-            decoded = line.decode(errors="replace")
-            stderr_tail.append(decoded.strip())
-
-            match = time_regex.search(decoded)
-            if match:
-                h, m, s = match.groups()
-                current = int(h) * 3600 + int(m) * 60 + float(s)
-                percent = min(int(current / duration * 100), 100)
-
-                now = time.time()
-                if now - last_update >= 1:  # обновление не чаще 1 раза в секунду
-                    bar = progress_bar(percent)
-                    await _safe_edit_status(status_msg, f"⏳ Обрабатываю видео…\n{bar} {percent}%")
-                    last_update = now
-
-        await process.wait()
+            await stderr_task
 
         # 6) если ошибка — пишем пользователю
         if process.returncode != 0:
@@ -340,16 +610,13 @@ async def convert_video_to_circle(message: Message, bot, effect: str = "normal")
             if user_id:
                 tail = "\n".join([t for t in stderr_tail if t])
                 print("ffmpeg failed", process.returncode)
-                print("ffmpeg cmd:", cmd)
+                print("ffmpeg cmd:", shlex.join(cmd))
                 if tail:
                     print("ffmpeg stderr tail:\n" + tail)
                 metrics_db.log_event(
                     user_id,
                     "video_error",
-                    message_id=message.message_id,
-                    effect=effect,
-                    video_duration=float(video.duration) if video.duration is not None else None,
-                    video_file_size=int(video.file_size) if video.file_size is not None else None,
+                    **evt,
                     error=("ffmpeg_nonzero_returncode\n" + tail)[-2000:],
                 )
             return
@@ -358,35 +625,17 @@ async def convert_video_to_circle(message: Message, bot, effect: str = "normal")
         await message.answer_video_note(FSInputFile(output_file))
 
         if user_id:
-            metrics_db.log_event(
-                user_id,
-                "video_success",
-                message_id=message.message_id,
-                effect=effect,
-                video_duration=float(video.duration) if video.duration is not None else None,
-                video_file_size=int(video.file_size) if video.file_size is not None else None,
-            )
+            metrics_db.log_event(user_id, "video_success", **evt)
 
         # 8) обновляем статус
         await _safe_edit_status(status_msg, "✅ Готово! Вот твой кружок ⭕️")
 
     except Exception as e:
         if user_id:
-            metrics_db.log_event(
-                user_id,
-                "video_error",
-                message_id=message.message_id,
-                effect=effect,
-                video_duration=float(video.duration) if video.duration is not None else None,
-                video_file_size=int(video.file_size) if video.file_size is not None else None,
-                error=str(e)[:500],
-            )
+            metrics_db.log_event(user_id, "video_error", **evt, error=str(e)[:500])
         if status_msg is not None:
             await _safe_edit_status(status_msg, "❌ Ошибка обработки видео")
         return
     finally:
-        # 9) удаляем временные файлы
-        if os.path.exists(input_file):
-            os.remove(input_file)
-        if os.path.exists(output_file):
-            os.remove(output_file)
+        # 9) удаляем временные файлы уже после ответа пользователю
+        asyncio.get_running_loop().call_soon(_remove_files, input_file, output_file)